@@ -0,0 +1,202 @@
+"""Micro-benchmarks for the daemon manager.
+
+These aren't run as part of the test suite.  Run them with::
+
+  python -m zdaemon.tests.benchmarks [name ...]
+
+Each benchmark prints one line per variant it compares.
+"""
+
+import os
+import select
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+from zdaemon import zdrun
+
+
+def legacy_wait(deadline, fds):
+    """Wait until `deadline` (a time.time value) like the old select loop.
+
+    The fd lists are rebuilt and the timeout recomputed from the wall
+    clock on every pass, as `Daemonizer.runforever` used to do.
+    """
+    while True:
+        timeout = max(0, deadline - time.time())
+        if timeout <= 0:
+            return
+        select.select(list(fds), [], [], timeout)
+
+
+def reactor_wait(reactor, delay):
+    done = []
+    reactor.call_later(delay, done.append, 1)
+    while not done:
+        reactor.run_once()
+
+
+def bench_wakeup(n=200, delay=0.005, nfds=32):
+    """Lateness of timer wakeups with `nfds` idle descriptors watched."""
+    pipes = [os.pipe() for i in range(nfds)]
+    readers = [r for r, w in pipes]
+    reactor = zdrun.Reactor()
+    for r in readers:
+        reactor.register(r, lambda: None)
+    try:
+        for name, wait in (
+                ('select', lambda: legacy_wait(time.time() + delay, readers)),
+                ('reactor', lambda: reactor_wait(reactor, delay)),
+        ):
+            late = []
+            for i in range(n):
+                start = time.monotonic()
+                wait()
+                late.append(time.monotonic() - start - delay)
+            late.sort()
+            print("wakeup %-8s median %7.1fus  p99 %7.1fus" % (
+                name, late[n // 2] * 1e6, late[n * 99 // 100] * 1e6))
+    finally:
+        reactor.close()
+        for r, w in pipes:
+            os.close(r)
+            os.close(w)
+
+
+def bench_idle(seconds=2.0, delay=0.1, nfds=32):
+    """CPU time used while idle with periodic deadlines pending."""
+    pipes = [os.pipe() for i in range(nfds)]
+    readers = [r for r, w in pipes]
+    reactor = zdrun.Reactor()
+    for r in readers:
+        reactor.register(r, lambda: None)
+    try:
+        for name, wait in (
+                ('select', lambda: legacy_wait(time.time() + delay, readers)),
+                ('reactor', lambda: reactor_wait(reactor, delay)),
+        ):
+            cpu = time.process_time()
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                wait()
+            cpu = time.process_time() - cpu
+            print("idle   %-8s %7.1fus CPU per second" % (
+                name, cpu / seconds * 1e6))
+    finally:
+        reactor.close()
+        for r, w in pipes:
+            os.close(r)
+            os.close(w)
+
+
+EXIT_PROGRAM = """\
+import os, sys, time
+with open(sys.argv[1], 'w') as f:
+    f.write(repr(time.monotonic()))
+os._exit(0)
+"""
+
+
+def bench_exit(n=30):
+    """Latency from a child's exit until `reportstatus` could run.
+
+    The child writes its CLOCK_MONOTONIC time just before exiting;
+    the clock is system-wide on Linux, so it can be compared with the
+    time at which the manager's loop notices the exit.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        exit_latencies(tmpdir, n)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def exit_latencies(tmpdir, n):
+    stamp = os.path.join(tmpdir, 'stamp')
+    options = zdrun.ZDRunOptions()
+    options.realize(['-s', os.path.join(tmpdir, 'zdsock'),
+                     sys.executable, '-c', EXIT_PROGRAM, stamp])
+    modes = ['sigchld']
+    if zdrun.pidfd_supported():
+        modes.append('pidfd')
+    for mode in modes:
+        d = zdrun.Daemonizer()
+        d.options = options
+        d.logger = options.logger
+        d.proc = zdrun.Subprocess(options, child_exits=zdrun._ChildExits())
+        d.procs = [d.proc]
+        d.usepidfd = mode == 'pidfd'
+        d.reactor = zdrun.Reactor()
+        d.waitstatuses = []
+        d.opensignalpipe()
+        if not d.usepidfd:
+            signal.signal(signal.SIGCHLD, d.sigchild)
+        latencies = []
+        try:
+            for i in range(n):
+                d.spawn(d.proc)
+                while not d.waitstatuses:
+                    d.reactor.run_once()
+                now = time.monotonic()
+                with open(stamp) as f:
+                    latencies.append(now - float(f.read()))
+                del d.waitstatuses[:]
+                d.proc.setstatus(0)
+        finally:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.set_wakeup_fd(-1)
+            d.reactor.close()
+        latencies.sort()
+        print("exit   %-8s median %7.1fus  max %7.1fus" % (
+            mode, latencies[n // 2] * 1e6, latencies[-1] * 1e6))
+
+
+def bench_spawn(n=50, ballast=256):
+    """Time taken by `Subprocess.spawn` with each spawn method.
+
+    `ballast` megabytes are allocated and touched first, standing for
+    a manager that has grown large: fork() has to copy its page tables,
+    posix_spawn() doesn't.
+    """
+    ballast = bytearray(ballast << 20)
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+    methods = ['fork']
+    if hasattr(os, 'posix_spawn'):
+        methods.append('posix_spawn')
+    for method in methods:
+        options = zdrun.ZDRunOptions()
+        options.realize(['true'])
+        options.spawnmethod = method
+        proc = zdrun.Subprocess(options)
+        times = []
+        for i in range(n):
+            start = time.monotonic()
+            pid = proc.spawn()
+            times.append(time.monotonic() - start)
+            os.waitpid(pid, 0)
+            proc.setstatus(0)
+        times.sort()
+        print("spawn  %-11s median %7.1fus  max %7.1fus" % (
+            method, times[n // 2] * 1e6, times[-1] * 1e6))
+
+
+benchmarks = {
+    'wakeup': bench_wakeup,
+    'idle': bench_idle,
+    'exit': bench_exit,
+    'spawn': bench_spawn,
+}
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    for name in args or sorted(benchmarks):
+        benchmarks[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -105,6 +105,7 @@ def dont_hang_when_program_doesnt_start():
     ... <runner>
     ...   program sleep
     ...   backoff-limit 2
+    ...   settle-time 1
     ... </runner>
     ... ''')
 
@@ -182,6 +183,368 @@ def test_stop_timeout():
     """
 
 
+def test_sigchld_child_tracking():
+    """
+    Where pidfds are available, they are used to watch the program.
+    The SIGCHLD handler is still available as a fallback:
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program sleep 100
+    ...   child-tracking sigchld
+    ... </runner>
+    ... ''')
+
+    >>> system("./zdaemon -Cconf start")
+    . .
+    daemon process started, pid=1234
+
+    >>> system("./zdaemon -Cconf stop")
+    . .
+    daemon process stopped
+
+    Bad values are rejected:
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program sleep 100
+    ...   child-tracking magic
+    ... </runner>
+    ... ''')
+
+    >>> system("./zdaemon -Cconf start") # doctest: +ELLIPSIS
+    Error: child tracking must be auto, pidfd or sigchld, not 'magic'...
+    Failed: 2
+
+    """
+
+
+def test_numprocs():
+    r"""
+    Several identical instances of a program can be run by one daemon
+    manager:
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program sleep 10%(instance)s
+    ...   numprocs 3
+    ... </runner>
+    ... ''')
+
+    >>> system("./zdaemon -Cconf start")
+    . .
+    daemon process started, pid=1234
+
+    >>> def instances():
+    ...     out = subprocess.check_output(
+    ...         "./zdaemon -Cconf status -l", shell=True).decode()
+    ...     return re.findall(
+    ...         r"(?m)^instance=(\d) status=(\w+) application=(\d+)", out)
+    >>> [(i, status) for (i, status, pid) in instances()]
+    [('0', 'running'), ('1', 'running'), ('2', 'running')]
+
+    Each instance got its own arguments:
+
+    >>> for i, status, pid in instances():
+    ...     print(read('/proc/%s/cmdline' % pid).split('\0'))
+    ['sleep', '100', '']
+    ['sleep', '101', '']
+    ['sleep', '102', '']
+
+    Instances can be stopped and signalled individually:
+
+    >>> system("./zdaemon -Cconf stop 1")
+    . .
+    daemon process stopped
+
+    >>> system("./zdaemon -Cconf status 1")
+    daemon manager running; daemon process not running
+
+    >>> system("./zdaemon -Cconf kill KILL 7")
+    Bad selector '7'
+    >>> system("./zdaemon -Cconf status 7")
+    Bad selector '7'
+    Failed: 1
+    >>> system("./zdaemon -Cconf stop 7")
+    Bad selector '7'
+    Failed: 1
+
+    >>> pid = instances()[2][2]
+    >>> system("./zdaemon -Cconf kill KILL 2")
+    Signal 9 sent
+
+    >>> import time
+    >>> time.sleep(1.5)
+    >>> [(i, status) for (i, status, p) in instances()]
+    [('0', 'running'), ('1', 'stopped'), ('2', 'running')]
+    >>> instances()[2][2] != pid
+    True
+
+    >>> system("./zdaemon -Cconf stop")
+    . .
+    daemon process stopped
+
+    >>> system("./zdaemon -Cconf status")
+    daemon manager not running
+    Failed: 3
+    """
+
+
+def test_programs():
+    r"""
+    One daemon manager can supervise several named programs, each with
+    its own options:
+
+    >>> write('web', '#!/bin/sh\necho web started\nexec sleep 100\n')
+    >>> os.chmod('web', 0o755)
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ... </runner>
+    ... <program web>
+    ...   program ./web
+    ...   transcript web.log
+    ... </program>
+    ... <program worker>
+    ...   program sleep 10%(instance)s
+    ...   numprocs 2
+    ... </program>
+    ... ''')
+
+    >>> system("./zdaemon -Cconf start")
+    . .
+    daemon process started, pid=1234
+
+    >>> def instances(*selectors):
+    ...     out = subprocess.check_output(
+    ...         "./zdaemon -Cconf status -l " + " ".join(selectors),
+    ...         shell=True).decode()
+    ...     return re.findall(
+    ...         r"(?m)^program=(\w+) instance=(\d) status=(\w+)", out)
+    >>> for instance in instances():
+    ...     print(instance)
+    ('web', '0', 'running')
+    ('worker', '0', 'running')
+    ('worker', '1', 'running')
+    >>> for instance in instances('worker:1', 'web'):
+    ...     print(instance)
+    ('worker', '1', 'running')
+    ('web', '0', 'running')
+
+    Programs can be stopped and started by name:
+
+    >>> system("./zdaemon -Cconf stop web")
+    . .
+    daemon process stopped
+
+    >>> for instance in instances():
+    ...     print(instance)
+    ('web', '0', 'stopped')
+    ('worker', '0', 'running')
+    ('worker', '1', 'running')
+
+    >>> system("./zdaemon -Cconf start web")
+    . .
+    daemon process started, pid=1234
+
+    >>> system("./zdaemon -Cconf kill KILL nosuch")
+    Bad selector 'nosuch'
+
+    >>> system("./zdaemon -Cconf stop")
+    . .
+    daemon process stopped
+
+    >>> system("./zdaemon -Cconf status")
+    daemon manager not running
+    Failed: 3
+
+    A selector can be given when the daemon manager isn't running yet:
+
+    >>> system("./zdaemon -Cconf start worker")
+    <BLANKLINE>
+    daemon process started, pid=1234
+    >>> for instance in instances():
+    ...     print(instance)
+    ('web', '0', 'stopped')
+    ('worker', '0', 'running')
+    ('worker', '1', 'running')
+    >>> print(re.search('numprocs=.*', subprocess.check_output(
+    ...     "./zdaemon -Cconf status -l worker", shell=True).decode())[0])
+    numprocs=2
+
+    Restarting restarts the selected programs, whatever the state of
+    the others:
+
+    >>> import json
+    >>> def pids(selector):
+    ...     return [proc['pid'] for proc in json.loads(subprocess.check_output(
+    ...         "./zdaemon -Cconf status --json " + selector,
+    ...         shell=True))['processes']]
+    >>> before = pids('worker')
+    >>> system("./zdaemon -Cconf restart worker")
+    <BLANKLINE>
+    daemon process restarted, pid=1234
+    >>> [a != b for a, b in zip(before, pids('worker'))]
+    [True, True]
+    >>> pids('web')
+    [None]
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+
+    Programs with their own transcript get their own transcript file:
+
+    >>> print(read('web.log'), end='')
+    web started
+    web started
+    """
+
+
+def test_json_status():
+    r"""
+    The status command can return a JSON document for scripts:
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program sleep 100
+    ... </runner>
+    ... ''')
+
+    >>> system("./zdaemon -Cconf start")
+    . .
+    daemon process started, pid=1234
+
+    >>> import json
+    >>> def status():
+    ...     return json.loads(subprocess.check_output(
+    ...         "./zdaemon -Cconf status --json", shell=True))
+    >>> document = status()
+    >>> document['version'], document['should_be_up']
+    (1, True)
+    >>> [proc] = document['processes']
+    >>> proc['state'], proc['args'], proc['restarts'], proc['last_exit']
+    ('running', ['sleep', '100'], 0, None)
+    >>> proc['pid'] == int(read('/proc/%d/stat' % proc['pid']).split()[0])
+    True
+
+    After the program is killed and restarted, the status tells how it
+    exited:
+
+    >>> system("./zdaemon -Cconf kill KILL")
+    kill(NNN, MM)
+    signal SIGKILL sent to process NNN
+    >>> import time
+    >>> time.sleep(1.5)
+    >>> [proc] = status()['processes']
+    >>> proc['state'], proc['restarts']
+    ('running', 1)
+    >>> proc['last_exit']['signal'], proc['last_exit']['exitstatus']
+    ('SIGKILL', None)
+    >>> print(proc['last_exit']['message'])
+    terminated by SIGKILL
+
+    >>> system("./zdaemon -Cconf stop")
+    . .
+    daemon process stopped
+    """
+
+
+def test_subscribe():
+    r"""
+    The subscribe command streams events as they happen:
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program sleep 100
+    ... </runner>
+    ... ''')
+
+    >>> system("./zdaemon -Cconf start")
+    . .
+    daemon process started, pid=1234
+
+    >>> import json
+    >>> subscriber = subprocess.Popen(
+    ...     "./zdaemon -Cconf subscribe", shell=True, stdout=subprocess.PIPE)
+    >>> json.loads(subscriber.stdout.readline())['event']
+    'subscribed'
+
+    >>> system("./zdaemon -Cconf kill KILL")
+    kill(NNN, MM)
+    signal SIGKILL sent to process NNN
+    >>> import time
+    >>> time.sleep(1.5)
+    >>> system("./zdaemon -Cconf stop")
+    . .
+    daemon process stopped
+
+    The stream ends when the daemon manager exits:
+
+    >>> for line in subscriber.stdout:
+    ...     event = json.loads(line)
+    ...     print(event['event'], event['program'], event['instance'],
+    ...           event.get('signal'), event.get('delay'))
+    exited None 0 SIGKILL None
+    backoff None 0 None 1.0
+    spawned None 0 None None
+    ready None 0 None None
+    stopping None 0 SIGTERM None
+    exited None 0 SIGTERM None
+    >>> subscriber.wait()
+    0
+    >>> subscriber.stdout.close()
+    """
+
+
+def test_wait_command():
+    r"""
+    The wait command of the daemon manager replies once the program
+    reaches a state, or when a timeout expires:
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program sleep 100
+    ... </runner>
+    ... ''')
+
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=1234
+
+    >>> import socket
+    >>> def action(command):
+    ...     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    ...     sock.connect('zdsock')
+    ...     sock.sendall(command.encode() + b'\n')
+    ...     return sock
+    >>> def reply(sock):
+    ...     with sock, sock.makefile() as f:
+    ...         print(f.read(), end='')
+
+    >>> reply(action('wait running'))
+    running
+    >>> reply(action('wait stopped 0.1'))
+    Timed out waiting for stopped
+    >>> reply(action('wait sleeping'))
+    Bad state 'sleeping'; use running or stopped
+
+    A waiting client gets its reply as soon as the state is reached:
+
+    >>> waiting = action('wait stopped -')
+    >>> reply(action('stop'))
+    Sent SIGTERM
+    >>> reply(waiting)
+    stopped
+    """
+
+
 def test_kill():
     """
 
@@ -354,6 +717,783 @@ def test_start_test_program():
     """
 
 
+def test_ready_probe():
+    """
+    A ready probe is checked by the daemon manager itself, without
+    running a start test program:
+
+    >>> write('t.py',
+    ... '''
+    ... import time
+    ... time.sleep(1)
+    ... open('x', 'w').close()
+    ... time.sleep(99)
+    ... ''')
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program %s t.py
+    ...   ready-probe file://%s/x
+    ...   probe-interval 0.1
+    ... </runner>
+    ... <eventlog>
+    ...   level debug
+    ...   <logfile>
+    ...      path log
+    ...      level debug
+    ...   </logfile>
+    ... </eventlog>
+    ... ''' % (sys.executable, os.getcwd()))
+
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=21446
+
+    >>> os.path.exists('x')
+    True
+    >>> with open("log") as f:
+    ...   logged = f.read()
+    >>> logged.count("ready probe succeeded")
+    1
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+    """
+
+
+def test_notify():
+    r"""
+    With the notify option, a program tells the daemon manager that
+    it's started by sending READY=1 to the socket named by the
+    NOTIFY_SOCKET environment variable, like with systemd:
+
+    >>> write('t.py',
+    ... '''
+    ... import os, socket, sys, time
+    ... def notify(message):
+    ...     sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    ...     sock.sendto(message, os.environ['NOTIFY_SOCKET'])
+    ... time.sleep(0.5)
+    ... notify(b'READY=1\\nSTATUS=serving %s' %
+    ...        os.environ.get('WATCHDOG_USEC', '-').encode())
+    ... time.sleep(99)
+    ... ''')
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program %s t.py
+    ...   notify on
+    ... </runner>
+    ... <eventlog>
+    ...   level debug
+    ...   <logfile>
+    ...      path log
+    ...      level debug
+    ...   </logfile>
+    ... </eventlog>
+    ... ''' % sys.executable)
+
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=21446
+
+    >>> import json
+    >>> def status():
+    ...     [proc] = json.loads(subprocess.check_output(
+    ...         "./zdaemon -Cconf status --json", shell=True))['processes']
+    ...     return proc
+    >>> proc = status()
+    >>> proc['state'], proc['status_text']
+    ('running', 'serving -')
+    >>> with open("log") as f:
+    ...   logged = f.read()
+    >>> logged.count("notified ready")
+    1
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+
+    With a watchdog-timeout, the program must also send WATCHDOG=1 at
+    least that often, or it's restarted.  This one doesn't:
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program %s t.py
+    ...   notify on
+    ...   watchdog-timeout 2
+    ... </runner>
+    ... <eventlog>
+    ...   level debug
+    ...   <logfile>
+    ...      path log
+    ...      level debug
+    ...   </logfile>
+    ... </eventlog>
+    ... ''' % sys.executable)
+
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=21446
+    >>> status()['status_text']
+    'serving 2000000'
+
+    >>> import time
+    >>> time.sleep(3)
+    >>> status()['restarts'] > 0
+    True
+    >>> with open("log") as f:
+    ...   logged = f.read()
+    >>> "watchdog timeout; restarting" in logged
+    True
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+
+    The notification socket is removed when the daemon manager exits:
+
+    >>> time.sleep(0.1)
+    >>> os.path.exists('zdsock.notify')
+    False
+    """
+
+
+def test_resource_limits():
+    """
+    Resource limits and the OOM score are set for the program:
+
+    >>> write('t.py',
+    ... '''
+    ... import resource, time
+    ... with open('limits', 'w') as f:
+    ...     print(resource.getrlimit(resource.RLIMIT_NOFILE)[0],
+    ...           resource.getrlimit(resource.RLIMIT_CORE),
+    ...           resource.getrlimit(resource.RLIMIT_AS)[0] // 1024 ** 2,
+    ...           open('/proc/self/oom_score_adj').read().strip(),
+    ...           file=f)
+    ... time.sleep(99)
+    ... ''')
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program %s t.py
+    ...   rlimit-nofile 200
+    ...   rlimit-core 0:0
+    ...   rlimit-as 4GB
+    ...   oom-score-adj 500
+    ... </runner>
+    ... ''' % sys.executable)
+
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=21446
+    >>> print(read('limits'), end='')
+    200 (0, 0) 4096 500
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+
+    Limits are checked when the configuration is read:
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program sleep 1
+    ...   rlimit-nofile lots
+    ... </runner>
+    ... ''')
+    >>> system("./zdaemon -Cconf start")
+    ... # doctest: +ELLIPSIS
+    Error: invalid literal for int() with base 10: 'lots'...
+    """
+
+
+def test_scheduling():
+    """
+    The CPU affinity, nice value, I/O priority and scheduling policy of
+    the program can be set:
+
+    >>> write('t.py',
+    ... '''
+    ... import os, time
+    ... with open('scheduling', 'w') as f:
+    ...     print(sorted(os.sched_getaffinity(0)),
+    ...           os.getpriority(os.PRIO_PROCESS, 0),
+    ...           os.sched_getscheduler(0) == os.SCHED_BATCH,
+    ...           file=f)
+    ... time.sleep(99)
+    ... ''')
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program %s t.py
+    ...   cpu-affinity 0
+    ...   nice 10
+    ...   ionice best-effort:7
+    ...   scheduling-policy batch
+    ... </runner>
+    ... ''' % sys.executable)
+
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=21446
+    >>> print(read('scheduling'), end='')
+    [0] 10 True
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+    """
+
+
+def test_cgroup():
+    r"""
+    The program can be run in a cgroup (version 2).  Here, we use a
+    directory that looks like one:
+
+    >>> os.makedirs('cg/web')
+    >>> for name, content in [
+    ...         ('cgroup.procs', ''), ('cgroup.kill', ''),
+    ...         ('memory.max', 'max\n'), ('pids.max', 'max\n'),
+    ...         ('memory.current', '1048576\n'),
+    ...         ('cpu.stat', 'usage_usec 300\nuser_usec 200\n'
+    ...                      'system_usec 100\nnr_periods 0\n'),
+    ...         ('io.stat', '8:0 rbytes=10 wbytes=20 rios=1 wios=2\n'
+    ...                     '8:16 rbytes=1 wbytes=2 rios=1 wios=1\n')]:
+    ...     write(os.path.join('cg/web', name), content)
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program sleep 100
+    ...   cgroup %s/cg/web
+    ...   cgroup-memory-max 512MB
+    ...   cgroup-pids-max 50
+    ... </runner>
+    ... ''' % os.getcwd())
+
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=21446
+
+    The program joined the cgroup before it was executed, and the
+    limits were written:
+
+    >>> import json
+    >>> [proc] = json.loads(subprocess.check_output(
+    ...     "./zdaemon -Cconf status --json", shell=True))['processes']
+    >>> read('cg/web/cgroup.procs') == str(proc['pid'])
+    True
+    >>> read('cg/web/memory.max'), read('cg/web/pids.max')
+    ('536870912', '50')
+
+    The status reports the resource usage of the cgroup:
+
+    >>> cgroup = proc['cgroup']
+    >>> cgroup.pop('path') == os.path.join(os.getcwd(), 'cg/web')
+    True
+    >>> for key, value in sorted(cgroup.items()):
+    ...     print(key, value)
+    cpu_system_usec 100
+    cpu_usage_usec 300
+    cpu_user_usec 200
+    io_rbytes 11
+    io_wbytes 22
+    memory_current 1048576
+
+    When the daemon manager sends SIGKILL, it kills the whole cgroup:
+
+    >>> system("./zdaemon -Cconf kill KILL '*'")
+    Signal 9 sent
+    >>> read('cg/web/cgroup.kill')
+    '1'
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+    """
+
+
+def test_memory_limit():
+    """
+    A program whose memory use stays above memory-limit is restarted:
+
+    >>> write('t.py',
+    ... '''
+    ... import time
+    ... data = bytearray(50 * 1024 ** 2)
+    ... data[::4096] = b'x' * len(data[::4096])
+    ... time.sleep(99)
+    ... ''')
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program %s t.py
+    ...   memory-limit 30MB
+    ...   memory-check-interval 0.1
+    ...   memory-grace 0.3
+    ...   memory-cooldown 60
+    ... </runner>
+    ... ''' % sys.executable)
+
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=21446
+
+    >>> import json, time
+    >>> def status():
+    ...     [proc] = json.loads(subprocess.check_output(
+    ...         "./zdaemon -Cconf status --json", shell=True))['processes']
+    ...     return proc
+    >>> time.sleep(1.5)
+    >>> proc = status()
+    >>> proc['recycles'], proc['restarts']
+    (1, 1)
+    >>> proc['last_recycle']['memory'] > 50 * 1024 ** 2
+    True
+
+    The restarted program uses as much memory, but isn't restarted
+    again during the cooldown period:
+
+    >>> time.sleep(1)
+    >>> proc = status()
+    >>> proc['recycles'], proc['restarts'], proc['memory'] > 50 * 1024 ** 2
+    (1, 1, True)
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+    """
+
+
+def test_stop_signals():
+    """
+    The stop-signals option sets the signals sent to stop the program,
+    each with a timeout after which the next one is sent:
+
+    >>> write('t.py',
+    ... '''
+    ... import signal, time
+    ... def quit(*args):
+    ...     open('stack', 'w').close()
+    ... signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ... signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    ... signal.signal(signal.SIGQUIT, quit)
+    ... time.sleep(99)
+    ... ''')
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program %s t.py
+    ...   stop-signals INT:0.2 TERM:0.2 QUIT:0.2 KILL
+    ... </runner>
+    ... <eventlog>
+    ...   level info
+    ...   <logfile>
+    ...      path log
+    ...   </logfile>
+    ... </eventlog>
+    ... ''' % sys.executable)
+
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=21446
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+
+    >>> os.path.exists('stack')
+    True
+    >>> with open('log') as f:
+    ...     for line in f:
+    ...         if 'stop step' in line:
+    ...             print(line.split(' ', 3)[-1], end='')
+    ...         if 'terminated' in line:
+    ...             print(line[line.index('terminated'):], end='')
+    sending SIGINT to process (stop step 1 of 4)
+    sending SIGTERM to process (stop step 2 of 4)
+    sending SIGQUIT to process (stop step 3 of 4)
+    sending SIGKILL to process (stop step 4 of 4)
+    terminated by SIGKILL
+    """
+
+
+def test_process_group():
+    """
+    With process-group, the program runs in a process group of its own,
+    and stopping it stops the processes it started, too.  Here, the
+    program exits when asked to, but leaves a helper that ignores SIGTERM
+    behind:
+
+    >>> write('t.py',
+    ... '''
+    ... import os, signal, subprocess, sys, time
+    ... helper = subprocess.Popen([sys.executable, '-c',
+    ...     'import signal, time; '
+    ...     'signal.signal(signal.SIGTERM, signal.SIG_IGN); '
+    ...     'time.sleep(99)'])
+    ... with open('helper', 'w') as f:
+    ...     f.write('%d %d' % (helper.pid, os.getpgid(0)))
+    ... time.sleep(99)
+    ... ''')
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program %s t.py
+    ...   process-group on
+    ...   stop-signals TERM:0.5 KILL
+    ... </runner>
+    ... <eventlog>
+    ...   level info
+    ...   <logfile>
+    ...      path log
+    ...   </logfile>
+    ... </eventlog>
+    ... ''' % sys.executable)
+
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=21446
+
+    >>> import time
+    >>> while not os.path.exists('helper'):
+    ...     time.sleep(0.1)
+    >>> time.sleep(0.1)
+    >>> helper, pgid = map(int, read('helper').split())
+    >>> os.getpgid(helper) == pgid != os.getpgid(0)
+    True
+
+    The kill command signals the whole group, too:
+
+    >>> system("./zdaemon -Cconf kill STOP")
+    kill(NNN, MM)
+    signal SIGSTOP sent to process NNN
+    >>> time.sleep(0.1)
+    >>> read('/proc/%d/stat' % helper).rsplit(')', 1)[1].split()[0]
+    'T'
+    >>> system("./zdaemon -Cconf kill CONT")
+    kill(NNN, MM)
+    signal SIGCONT sent to process NNN
+
+    Stopping waits until the helper is gone, too:
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+
+    >>> from zdaemon.zdrun import group_alive
+    >>> group_alive(pgid)
+    False
+    >>> with open('log') as f:
+    ...     for line in f:
+    ...         if 'stop step' in line or 'process group' in line:
+    ...             line = line.split(' ', 3)[-1].split(': ')[-1]
+    ...             print(line.replace(str(pgid), 'PGID'), end='')
+    sending SIGTERM to process (stop step 1 of 2)
+    terminated by SIGTERM; waiting for the rest of process group PGID
+    sending SIGKILL to process (stop step 2 of 2)
+    process group PGID exited
+    """
+
+
+def test_subreaper():
+    """
+    With subreaper, processes the program leaves behind become children
+    of the daemon manager.  Here, the program starts a helper the way
+    daemons do, by forking twice:
+
+    >>> write('t.py',
+    ... '''
+    ... import os, time
+    ... if not os.fork():
+    ...     if not os.fork():
+    ...         with open('stray.tmp', 'w') as f:
+    ...             f.write(str(os.getpid()))
+    ...         os.rename('stray.tmp', 'stray')
+    ...         time.sleep(99)
+    ...     os._exit(0)
+    ... os.wait()
+    ... time.sleep(99)
+    ... ''')
+
+    >>> import json, time
+    >>> def status():
+    ...     return json.loads(subprocess.check_output(
+    ...         "./zdaemon -Cconf status --json", shell=True))
+
+    >>> for tracking in 'auto', 'sigchld':
+    ...     write('conf',
+    ...     '''
+    ...     <runner>
+    ...       program %s t.py
+    ...       subreaper on
+    ...       child-tracking %s
+    ...     </runner>
+    ...     ''' % (sys.executable, tracking))
+    ...     system("./zdaemon -Cconf start")
+    ...     while not os.path.exists('stray'):
+    ...         time.sleep(0.1)
+    ...     stray = int(read('stray'))
+    ...     os.remove('stray')
+    ...     document = status()
+    ...     parent = int(read('/proc/%d/stat' % stray).split()[3])
+    ...     print(document['strays'] == dict(reaped=0, pids=[stray]),
+    ...           parent == document['manager'])
+    ...
+    ...     # Once it exits, it's reaped rather than left as a zombie:
+    ...     os.kill(stray, signal.SIGTERM)
+    ...     while status()['strays']['reaped'] != 1:
+    ...         time.sleep(0.1)
+    ...     print(status()['strays'])
+    ...     system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process started, pid=21446
+    True True
+    {'pids': [], 'reaped': 1}
+    <BLANKLINE>
+    daemon process stopped
+    <BLANKLINE>
+    daemon process started, pid=21446
+    True True
+    {'pids': [], 'reaped': 1}
+    <BLANKLINE>
+    daemon process stopped
+    """
+
+
+def test_listen():
+    """
+    The daemon manager can listen for the program, which gets the
+    sockets the way systemd passes them:
+
+    >>> write('t.py',
+    ... '''
+    ... import os, socket
+    ... assert os.environ['LISTEN_PID'] == str(os.getpid())
+    ... names = os.environ['LISTEN_FDNAMES'].split(':')
+    ... assert len(names) == int(os.environ['LISTEN_FDS'])
+    ... sock = socket.socket(fileno=3)
+    ... while True:
+    ...     conn, addr = sock.accept()
+    ...     conn.sendall(('%s %s' % (names[0], os.getpid())).encode())
+    ...     conn.close()
+    ... ''')
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program %s t.py
+    ...   listen app=unix://%s/app.sock tcp://127.0.0.1:0
+    ... </runner>
+    ... ''' % (sys.executable, os.getcwd()))
+
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=21446
+
+    >>> import json, socket
+    >>> def status():
+    ...     return json.loads(subprocess.check_output(
+    ...         "./zdaemon -Cconf status --json", shell=True))
+    >>> def ask():
+    ...     sock = socket.socket(socket.AF_UNIX)
+    ...     sock.connect('app.sock')
+    ...     with sock:
+    ...         name, pid = sock.recv(100).decode().split()
+    ...     return name, int(pid)
+    >>> [proc] = status()['processes']
+    >>> [(listener['name'], listener['address'][:6])
+    ...  for listener in proc['listen']]
+    [('app', 'unix:/'), ('unknown', 'tcp://')]
+    >>> ask() == ('app', proc['pid'])
+    True
+
+    The socket stays open while the program restarts, so connections
+    made meanwhile are answered by the new process rather than refused:
+
+    >>> system("./zdaemon -Cconf restart")
+    <BLANKLINE>
+    daemon process restarted, pid=21447
+    >>> name, pid = ask()
+    >>> pid != proc['pid']
+    True
+
+    The socket is removed when the daemon manager exits:
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+    >>> import time
+    >>> for i in range(50):
+    ...     if not os.path.exists('app.sock'):
+    ...         break
+    ...     time.sleep(0.1)
+    >>> os.path.exists('app.sock')
+    False
+    """
+
+
+def test_fd_store():
+    r"""
+    With fd-store-max, the program can leave file descriptors with the
+    daemon manager, and gets them back when it's restarted.  This one
+    stores the reading end of a pipe with something in it, then crashes:
+
+    >>> write('t.py',
+    ... '''
+    ... import os, socket, sys, time
+    ... if 'LISTEN_FDS' in os.environ:
+    ...     with open('resumed', 'w') as f:
+    ...         f.write('%s %s %s' % (
+    ...             os.environ['LISTEN_FDS'], os.environ['LISTEN_FDNAMES'],
+    ...             os.read(3, 100).decode()))
+    ...     time.sleep(99)
+    ... r, w = os.pipe()
+    ... os.write(w, b'state')
+    ... sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    ... sock.connect(os.environ['NOTIFY_SOCKET'])
+    ... for name, fd in (b'cache', r), (b'other', r):
+    ...     socket.send_fds(sock, [b'FDSTORE=1\\nFDNAME=' + name], [fd])
+    ... sock.send(b'FDSTOREREMOVE=1\\nFDNAME=other')
+    ... time.sleep(0.5)
+    ... sys.exit(1)
+    ... ''')
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program %s t.py
+    ...   fd-store-max 2
+    ... </runner>
+    ... ''' % sys.executable)
+
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=21446
+
+    >>> import time
+    >>> for i in range(100):
+    ...     if os.path.exists('resumed'):
+    ...         break
+    ...     time.sleep(0.1)
+    >>> time.sleep(0.1)
+    >>> print(read('resumed'))
+    1 cache state
+
+    >>> import json
+    >>> [proc] = json.loads(subprocess.check_output(
+    ...     "./zdaemon -Cconf status --json", shell=True))['processes']
+    >>> proc['fd_store']
+    ['cache']
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+    """
+
+
+def test_overlapping_restart():
+    r"""
+    With the overlap restart mode, restarting starts the next generation
+    of the program first.  The running one keeps serving until the new
+    one is ready.  This program tells it's ready once there's a go file:
+
+    >>> write('t.py',
+    ... '''
+    ... import os, socket, sys, time
+    ... while not os.path.exists('go'):
+    ...     if os.path.exists('fail'):
+    ...         sys.exit(1)
+    ...     time.sleep(0.1)
+    ... sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    ... sock.sendto(b'READY=1', os.environ['NOTIFY_SOCKET'])
+    ... time.sleep(99)
+    ... ''')
+
+    >>> write('conf',
+    ... '''
+    ... <runner>
+    ...   program %s t.py
+    ...   notify on
+    ...   restart-mode overlap
+    ... </runner>
+    ... ''' % sys.executable)
+
+    >>> write('go', '')
+    >>> system("./zdaemon -Cconf start")
+    <BLANKLINE>
+    daemon process started, pid=21446
+    >>> os.remove('go')
+
+    >>> import json, socket, time
+    >>> def action(command):
+    ...     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    ...     sock.connect('zdsock')
+    ...     sock.sendall(command.encode() + b'\n')
+    ...     with sock, sock.makefile() as f:
+    ...         return f.read()
+    >>> def status():
+    ...     [proc] = json.loads(action('status --json'))['processes']
+    ...     return proc
+    >>> first = status()
+    >>> first['generation'], first['state'], first['retiring']
+    (1, 'running', [])
+
+    >>> print(action('restart'), end='')
+    Application started
+    >>> second = status()
+    >>> second['generation'], second['state'], second['pid'] != first['pid']
+    (2, 'starting', True)
+    >>> second['retiring'] == [dict(pid=first['pid'], generation=1,
+    ...                             state='running', stop_step=None)]
+    True
+
+    Once the new generation is ready, the old one is stopped:
+
+    >>> write('go', '')
+    >>> for i in range(100):
+    ...     second = status()
+    ...     if not second['retiring']:
+    ...         break
+    ...     time.sleep(0.1)
+    >>> second['generation'], second['state'], second['retiring']
+    (2, 'running', [])
+    >>> os.remove('go')
+
+    If the new generation exits before it's ready, the old one keeps
+    serving:
+
+    >>> write('fail', '')
+    >>> print(action('restart'), end='')
+    Application started
+    >>> for i in range(100):
+    ...     third = status()
+    ...     if third['pid'] == second['pid']:
+    ...         break
+    ...     time.sleep(0.1)
+    >>> third['generation'], third['state'], third['retiring']
+    (2, 'running', [])
+    >>> third['last_exit']['exitstatus']
+    1
+
+    >>> system("./zdaemon -Cconf stop")
+    <BLANKLINE>
+    daemon process stopped
+    """
+
+
 def test_start_timeout():
     """
     >>> write('t.py',
@@ -396,6 +1536,7 @@ def DAEMON_MANAGER_MODE_leak():
     ... <runner>
     ...   program env
     ...   transcript t
+    ...   settle-time 1
     ... </runner>
     ... ''')
 
@@ -413,6 +1554,7 @@ def nonzero_exit_on_program_failure():
     ... <runner>
     ...   backoff-limit 1
     ...   program nosuch
+    ...   settle-time 1
     ... </runner>
     ... ''')
 
@@ -426,6 +1568,7 @@ def nonzero_exit_on_program_failure():
     ... <runner>
     ...   backoff-limit 1
     ...   program cat nosuch
+    ...   settle-time 1
     ... </runner>
     ... ''')
 
@@ -439,6 +1582,7 @@ def nonzero_exit_on_program_failure():
     ... <runner>
     ...   backoff-limit 1
     ...   program pwd
+    ...   settle-time 1
     ... </runner>
     ... ''')
 
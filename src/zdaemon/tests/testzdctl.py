@@ -19,8 +19,9 @@ def doctest_ZDCmd_help():
         <BLANKLINE>
         Documented commands (type help <topic>):
         ========================================
-        fg          help  logreopen  reopen_transcript  show   status  wait
-        foreground  kill  logtail    restart            start  stop
+        fg          help  logreopen  reopen_transcript  show   status
+        subscribe
+        foreground  kill  logtail    restart            start  stop    wait
         <BLANKLINE>
 
         >>> run("help fg")
@@ -32,8 +33,8 @@ def doctest_ZDCmd_help():
         help <action> -- Print help for <action>.
 
         >>> run("help kill")
-        kill [sig] -- Send signal sig to the daemon process.
-                      The default signal is SIGTERM.
+        kill [sig] [selector ...] -- Send signal sig to the daemon process.
+                                     The default signal is SIGTERM.
 
         >>> run("help logreopen")
         logreopen -- Send a SIGUSR2 signal to the daemon process.
@@ -58,16 +59,21 @@ def doctest_ZDCmd_help():
         show all -- show all of the above
 
         >>> run("help start")
-        start -- Start the daemon process.
-                 If it is already running, do nothing.
+        start [selector ...] -- Start the daemon process.
+                                If it is already running, do nothing.
 
         >>> run("help status")
-        status [-l] -- Print status for the daemon process.
-                       With -l, show raw status output as well.
+        status [-l] [selector ...] -- Print status for the daemon process.
+                                      With -l, show raw status output as well.
+                                      With --json, print the status as JSON.
 
         >>> run("help stop")
-        stop -- Stop the daemon process.
-                If it is not running, do nothing.
+        stop [selector ...] -- Stop the daemon process.
+                               If it is not running, do nothing.
+
+        >>> run("help subscribe")
+        subscribe [selector ...] -- Print events as they happen.
+                                    Events are JSON objects, one per line.
 
         >>> run("help wait")
         wait -- Wait for the daemon process to exit.
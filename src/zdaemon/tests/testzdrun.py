@@ -1,13 +1,16 @@
 """Test suite for zdrun.py."""
 
+import logging
 import os
 import shutil
 import signal
 import socket
 import sys
 import tempfile
+import threading
 import time
 import unittest
+from contextlib import redirect_stderr
 from io import StringIO
 
 import ZConfig
@@ -416,6 +419,688 @@ class TestRunnerDirectory(unittest.TestCase):
         self.assertEqual([('chown', path, 27, 28)], calls)
 
 
+class TestChildTracking(unittest.TestCase):
+
+    def testWaitidStatus(self):
+        # waitid() results convert to the statuses waitpid() returns
+        for args, sig in ((["sh", "-c", "exit 3"], None),
+                          (["sleep", "100"], signal.SIGTERM)):
+            pid = os.spawnvp(os.P_NOWAIT, args[0], args)
+            if sig:
+                os.kill(pid, sig)
+            info = os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+            wpid, wsts = os.waitpid(pid, 0)
+            self.assertEqual(zdrun.waitid_status(info), wsts)
+            self.assertEqual(info.si_pid, wpid)
+
+    def _daemonizer(self, args, usepidfd):
+        options = zdrun.ZDRunOptions()
+        options.realize(args)
+        d = zdrun.Daemonizer()
+        d.options = options
+        d.logger = options.logger
+        d.proc = zdrun.Subprocess(options, child_exits=zdrun._ChildExits())
+        d.procs = [d.proc]
+        d.usepidfd = usepidfd
+        d.reactor = zdrun.Reactor()
+        d.waitstatuses = []
+        self.addCleanup(d.reactor.close)
+        return d
+
+    @unittest.skipUnless(zdrun.pidfd_supported(), "pidfd not supported")
+    def testPidfdChildTracking(self):
+        d = self._daemonizer(["sleep", "100"], usepidfd=True)
+        pid = d.spawn(d.proc)
+        self.assertIsNotNone(d.proc.pidfd)
+        d.proc.kill(signal.SIGKILL)
+        while not d.waitstatuses:
+            d.reactor.run_once(10)
+        [(wpid, sts)] = d.waitstatuses
+        self.assertEqual(wpid, pid)
+        self.assertEqual(zdrun.decode_wait_status(sts),
+                         (-1, "terminated by SIGKILL"))
+        self.assertIsNone(d.proc.pidfd)
+        self.assertEqual(d.reactor.selector.get_map().get(pid), None)
+        # The process has been reaped
+        self.assertRaises(ChildProcessError, os.waitpid, pid, os.WNOHANG)
+
+    def testChildTrackingOption(self):
+        d = self._daemonizer(["sleep", "100"], usepidfd=False)
+        d.options.childtracking = "sigchld"
+        self.assertFalse(d.choosechildtracking())
+        d.options.childtracking = "auto"
+        self.assertEqual(d.choosechildtracking(), zdrun.pidfd_supported())
+
+
+class TestSpawnMethod(unittest.TestCase):
+
+    def proc(self, args, **settings):
+        options = zdrun.ZDRunOptions()
+        options.realize(args)
+        for name, value in settings.items():
+            setattr(options, name, value)
+        return zdrun.Subprocess(options)
+
+    def testFdList(self):
+        from zdaemon.zdoptions import fd_list
+        self.assertEqual(fd_list("5 3,4"), [3, 4, 5])
+        self.assertRaises(ValueError, fd_list, "2")
+
+    def testChoice(self):
+        self.assertEqual(self.proc(['true']).useposixspawn,
+                         hasattr(os, 'posix_spawn'))
+        self.assertFalse(self.proc(['true'], spawnmethod='fork')
+                         .useposixspawn)
+        proc = self.proc(['true'], nice=5, rlimitnofile=(64, None))
+        self.assertEqual(proc.forkspawnreasons(), ['rlimit-nofile', 'nice'])
+        self.assertFalse(proc.useposixspawn)
+        stderr = StringIO()
+        with self.assertRaises(SystemExit), redirect_stderr(stderr):
+            self.proc(['true'], spawnmethod='posix_spawn', nice=5)
+        self.assertIn("posix_spawn can't be used with nice", stderr.getvalue())
+
+    def testDescriptors(self):
+        # The program's output goes where it should, and descriptors of
+        # the manager, even high ones, don't leak into it unless they're
+        # passed on.
+        r, w = os.pipe()
+        os.close(r)
+        leaked = os.dup2(w, 150)
+        passed = os.dup2(w, 152)
+        os.close(w)
+        self.addCleanup(os.close, leaked)
+        self.addCleanup(os.close, passed)
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        methods = ['fork']
+        if hasattr(os, 'posix_spawn'):
+            methods.append('posix_spawn')
+        for method in methods:
+            proc = self.proc(
+                [sys.executable, '-c',
+                 'import os; print(*sorted(map(int, os.listdir("/dev/fd"))))'],
+                spawnmethod=method, passfds=[passed])
+            path = os.path.join(tmp, method)
+            proc.output = os.open(path, os.O_WRONLY | os.O_CREAT)
+            try:
+                pid = proc.spawn()
+            finally:
+                os.close(proc.output)
+            os.waitpid(pid, 0)
+            with open(path) as f:
+                fds = [int(fd) for fd in f.read().split()]
+            self.assertEqual(fds[:3], [0, 1, 2])
+            self.assertNotIn(leaked, fds)
+            self.assertIn(passed, fds)
+
+    def testExecFailure(self):
+        # A program that can't be executed exits with status 127 after
+        # saying why, whatever the spawn method.
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        script = os.path.join(tmp, 'script')
+        with open(script, 'w') as f:
+            f.write('#!/no/such/interpreter\n')
+        os.chmod(script, 0o755)
+        methods = ['fork']
+        if hasattr(os, 'posix_spawn'):
+            methods.append('posix_spawn')
+        for method in methods:
+            proc = self.proc([script], spawnmethod=method)
+            proc.options.logger = logging.getLogger('zdaemon.tests')
+            path = os.path.join(tmp, method)
+            proc.output = os.open(path, os.O_WRONLY | os.O_CREAT)
+            try:
+                pid = proc.spawn()
+            finally:
+                os.close(proc.output)
+            self.assertTrue(pid)
+            self.assertEqual(
+                os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]), 127)
+            with open(path) as f:
+                self.assertIn("can't exec %r" % script, f.read())
+
+
+class TestReactor(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = zdrun.Reactor()
+        self.calls = []
+
+    def tearDown(self):
+        self.reactor.close()
+
+    def testTimersFireInDeadlineOrder(self):
+        reactor = self.reactor
+        reactor.call_later(0.02, self.calls.append, 'b')
+        reactor.call_later(0.01, self.calls.append, 'a')
+        reactor.call_later(60, self.calls.append, 'never')
+        while len(self.calls) < 2:
+            reactor.run_once()
+        self.assertEqual(self.calls, ['a', 'b'])
+        self.assertGreater(reactor.timeout(), 50)
+
+    def testCancelledTimersDontFire(self):
+        reactor = self.reactor
+        timer = reactor.call_later(0, self.calls.append, 'x')
+        timer.cancel()
+        self.assertIsNone(reactor.timeout())
+        reactor.run_once(0)
+        self.assertEqual(self.calls, [])
+
+    def testTimeoutLimitsWait(self):
+        reactor = self.reactor
+        reactor.call_later(0.05, self.calls.append, 'x')
+        reactor.run_once(0)
+        self.assertEqual(self.calls, [])
+        self.assertLessEqual(reactor.timeout(), 0.05)
+
+    def testTimersUseMonotonicClock(self):
+        # Stepping the wall clock doesn't affect deadlines.
+        reactor = self.reactor
+        timer = reactor.call_later(0.01, self.calls.append, 'x')
+        save_time = time.time
+        time.time = lambda: save_time() + 3600
+        try:
+            reactor.run_once()
+        finally:
+            time.time = save_time
+        self.assertEqual(self.calls, ['x'])
+        self.assertFalse(timer.active)
+
+    def testCallSoonThreadsafe(self):
+        reactor = self.reactor
+        thread = threading.Thread(
+            target=reactor.call_soon_threadsafe, args=(self.calls.append, 1))
+        thread.start()
+        thread.join()
+        reactor.run_once(1)
+        self.assertEqual(self.calls, [1])
+
+    def testIODispatch(self):
+        reactor = self.reactor
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+
+        def readable():
+            self.calls.append(os.read(r, 10))
+            reactor.unregister(r)
+
+        reactor.register(r, readable)
+        os.write(w, b'x')
+        reactor.run_once(1)
+        self.assertEqual(self.calls, [b'x'])
+        # Unregistering twice is harmless.
+        reactor.unregister(r)
+
+
+class TestControlConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = zdrun.Reactor()
+        self.commands = []
+
+    def tearDown(self):
+        self.reactor.close()
+
+    def oncommand(self, connection, line):
+        self.commands.append(line)
+        if line == b"big":
+            connection.send(b"x" * 1000000 + b"\n")
+        elif line == b"hold":
+            connection.hold()
+        else:
+            connection.send(b"reply to " + line + b"\n")
+
+    def connect(self):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        connection = zdrun.ControlConnection(
+            server, self.reactor, self.oncommand, logging.getLogger())
+        self.addCleanup(connection.close)
+        return client, connection
+
+    def testConcurrentClients(self):
+        # A client that hasn't sent its command yet doesn't keep
+        # others from being served.
+        stuck, stuck_connection = self.connect()
+        stuck.send(b"sta")
+        client, connection = self.connect()
+        client.send(b"status\n")
+        while not connection.closed:
+            self.reactor.run_once(1)
+        self.assertEqual(client.recv(1000), b"reply to status\n")
+        self.assertFalse(stuck_connection.closed)
+        stuck.send(b"tus\n")
+        while not stuck_connection.closed:
+            self.reactor.run_once(1)
+        self.assertEqual(stuck.recv(1000), b"reply to status\n")
+        self.assertEqual(self.commands, [b"status", b"status"])
+
+    def testSlowReader(self):
+        # A reply that doesn't fit in the socket buffer is sent as the
+        # client reads it.
+        client, connection = self.connect()
+        client.send(b"big\n")
+        while not self.commands:
+            self.reactor.run_once(1)
+        self.assertFalse(connection.closed)
+        received = b""
+        while received[-1:] != b"\n":
+            self.reactor.run_once(0)
+            received += client.recv(100000)
+        self.assertEqual(received, b"x" * 1000000 + b"\n")
+        self.assertTrue(connection.closed)
+
+    def testHold(self):
+        # A held connection stays open after the command, even when the
+        # client is done writing, until the command finishes it.
+        client, connection = self.connect()
+        client.send(b"hold\n")
+        client.shutdown(socket.SHUT_WR)
+        while not self.commands:
+            self.reactor.run_once(1)
+        self.reactor.run_once(0.01)
+        self.assertFalse(connection.closed)
+        self.assertFalse(connection.timer.active)
+        connection.send(b"event\n")
+        connection.finish()
+        while not connection.closed:
+            self.reactor.run_once(1)
+        self.assertEqual(client.recv(1000), b"event\n")
+
+    def testTimeout(self):
+        client, connection = self.connect()
+        connection.timer.cancel()
+        connection.timer = self.reactor.call_later(0.01, connection.expired)
+        while not connection.closed:
+            self.reactor.run_once(1)
+        self.assertEqual(client.recv(1000), b"")
+        self.assertEqual(self.commands, [])
+
+    def testUnterminatedCommand(self):
+        client, connection = self.connect()
+        client.send(b"status")
+        client.shutdown(socket.SHUT_WR)
+        while not connection.closed:
+            self.reactor.run_once(1)
+        self.assertEqual(client.recv(1000),
+                         b"Command not terminated by newline\n")
+
+
+class TestStartupReport(unittest.TestCase):
+
+    def testReportGoesToReadyFd(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        options = zdrun.ZDRunOptions()
+        options.realize(['--ready-fd=%d' % w, 'true'])
+        self.assertFalse(os.get_inheritable(w))
+        options.reportstartup('ready')
+        options.reportstartup('error: too late')
+        self.assertEqual(os.read(r, 100), b'ready\n')
+        self.assertEqual(os.read(r, 100), b'')  # closed after the report
+
+
+class TestTimeOptions(unittest.TestCase):
+    """Durations are non-negative numbers of seconds."""
+
+    def assertRejected(self, setting, message="non-negative"):
+        options = ConfiguredZDRunOptions(
+            "<runner>\n %s\n</runner>\n" % setting)
+        stderr = StringIO()
+        with self.assertRaises(SystemExit), redirect_stderr(stderr):
+            options.realize(["true"])
+        self.assertIn(message, stderr.getvalue())
+
+    def testSettleTime(self):
+        options = ConfiguredZDRunOptions(
+            "<runner>\n settle-time 0\n</runner>\n")
+        options.realize(["true"])
+        self.assertEqual(options.settletime, 0)
+        self.assertRejected("settle-time -1")
+
+    def testProbeOptions(self):
+        self.assertRejected("probe-interval -0.25")
+        self.assertRejected("probe-timeout -1")
+
+    def testWatchdogTimeout(self):
+        self.assertRejected("watchdog-timeout -5")
+
+    def testBackoffInitial(self):
+        # 0 would restart a crashing program in a busy loop.
+        options = ConfiguredZDRunOptions(
+            "<runner>\n backoff-initial 0.1\n</runner>\n")
+        options.realize(["true"])
+        self.assertEqual(options.backoffinitial, 0.1)
+        self.assertRejected("backoff-initial 0", "positive")
+        self.assertRejected("backoff-initial -1", "positive")
+
+
+class GovernorTests(unittest.TestCase):
+    """Base class for tests of the restart policy of a Daemonizer."""
+
+    def setUp(self):
+        self.options = zdrun.ZDRunOptions()
+        self.options.realize(['-b', '10', 'true'])
+        self.options.logger = logging.getLogger('zdaemon.tests')
+        self.daemonizer = zdrun.Daemonizer()
+        self.daemonizer.options = self.options
+        self.daemonizer.logger = self.options.logger
+        self.daemonizer.reactor = zdrun.Reactor()
+        self.addCleanup(self.daemonizer.reactor.close)
+
+
+class TestBackoff(GovernorTests):
+
+    def delays(self, n):
+        delays = []
+        backoff = 0
+        for i in range(n):
+            backoff = zdrun.next_backoff(backoff, self.options)
+            delays.append(backoff)
+        return delays
+
+    def testLinearByDefault(self):
+        self.assertEqual(self.delays(12), [1, 2, 3, 4, 5, 6, 7, 8, 9, 10,
+                                           10, 10])
+
+    def testExponential(self):
+        self.options.backoffinitial = 0.1
+        self.options.backoffmultiplier = 2
+        self.options.backoffmax = 1
+        self.assertEqual([round(d, 3) for d in self.delays(6)],
+                         [0.1, 0.2, 0.4, 0.8, 1, 1])
+
+    def crash(self, proc, uptime=0.1):
+        """Let the governor handle an exit after `uptime` seconds.
+
+        Return the restart delay, or None if there is none.
+        """
+        proc.lasttime = time.time() - uptime
+        self.daemonizer.governor(proc)
+        if proc.delay is None:
+            return None
+        return proc.delay.when - time.monotonic()
+
+    def testJitter(self):
+        self.options.backoffjitter = 0.5
+        proc = zdrun.Subprocess(self.options)
+        delays = [self.crash(proc) for i in range(3)]
+        for backoff, delay in zip([1, 2, 3], delays):
+            self.assertGreaterEqual(delay, backoff - 0.1)
+            self.assertLessEqual(delay, backoff + 0.5)
+        self.assertEqual((proc.backoff, proc.failures), (3, 3))
+
+    def testReset(self):
+        self.options.backoffreset = 1
+        proc = zdrun.Subprocess(self.options)
+        self.crash(proc)
+        self.crash(proc)
+        self.assertEqual((proc.backoff, proc.failures), (2, 2))
+        # Staying up longer than backoff-reset forgives the crashes.
+        self.assertIsNone(self.crash(proc, uptime=2))
+        self.assertEqual((proc.backoff, proc.failures), (0, 0))
+
+    def testGiveUp(self):
+        # The number of crashes counts, not the delay.
+        self.options.backoffmax = 0.5
+        proc = zdrun.Subprocess(self.options)
+        # Another running process keeps the manager from exiting.
+        other = zdrun.Subprocess(self.options)
+        other.pid = os.getpid()
+        self.daemonizer.procs = [proc, other]
+        for i in range(9):
+            self.crash(proc)
+        self.assertTrue(proc.should_be_up)
+        self.assertEqual(proc.backoff, 0.5)
+        self.crash(proc)
+        self.assertFalse(proc.should_be_up)
+
+
+class TestRestartLimit(GovernorTests):
+
+    def setUp(self):
+        GovernorTests.setUp(self)
+        self.options.restartlimit = 3
+        self.options.restartwindow = 10
+        self.options.circuitopentime = 60
+        self.proc = zdrun.Subprocess(self.options)
+        self.daemonizer.subscribers = []
+
+    def testCircuitOpens(self):
+        proc = self.proc
+        for i in range(3):
+            self.daemonizer.ratelimit(proc)
+            self.assertFalse(proc.circuitopen)
+        self.daemonizer.ratelimit(proc)
+        self.assertTrue(proc.circuitopen)
+        self.assertGreater(proc.delay.when - time.monotonic(), 59)
+        self.assertEqual(zdrun.procstate(proc), "backoff")
+        # When the circuit closes, the process may restart again.
+        self.daemonizer.delayexpired(proc)
+        self.assertFalse(proc.circuitopen)
+        self.assertIsNone(proc.delay)
+        for i in range(3):
+            self.daemonizer.ratelimit(proc)
+        self.assertFalse(proc.circuitopen)
+
+    def testOldRestartsDontCount(self):
+        proc = self.proc
+        for i in range(3):
+            self.daemonizer.ratelimit(proc)
+        for i in range(3):
+            proc.restarttimes.append(proc.restarttimes.popleft() - 10)
+        self.daemonizer.ratelimit(proc)
+        self.assertFalse(proc.circuitopen)
+        self.assertEqual(len(proc.restarttimes), 1)
+
+    def testStartClosesCircuit(self):
+        proc = self.proc
+        for i in range(4):
+            self.daemonizer.ratelimit(proc)
+        self.daemonizer.resetproc(proc, True)
+        self.assertFalse(proc.circuitopen)
+        self.assertIsNone(proc.delay)
+        self.assertEqual(len(proc.restarttimes), 0)
+
+    def testDisabled(self):
+        self.options.restartlimit = 0
+        for i in range(10):
+            self.daemonizer.ratelimit(self.proc)
+        self.assertFalse(self.proc.circuitopen)
+
+
+class TestCPUAffinity(unittest.TestCase):
+
+    def cpus(self, instances, cpuaffinity, cpusperinstance=0):
+        options = zdrun.ZDRunOptions()
+        options.realize(['true'])
+        options.cpuaffinity = cpuaffinity
+        options.cpusperinstance = cpusperinstance
+        return [zdrun.Subprocess(options, instance=i).cpus()
+                for i in range(instances)]
+
+    def testShared(self):
+        self.assertEqual(self.cpus(2, [2, 3]), [[2, 3], [2, 3]])
+        self.assertEqual(self.cpus(1, None, 1), [None])
+
+    def testSpread(self):
+        self.assertEqual(self.cpus(3, [4, 5, 6, 7], 2),
+                         [[4, 5], [6, 7], [4, 5]])
+        self.assertEqual(self.cpus(2, [0, 1, 2], 5), [[0, 1, 2], [0, 1, 2]])
+
+    def testCPUList(self):
+        from zdaemon.zdoptions import cpu_list
+        self.assertEqual(cpu_list("0-3, 8,2"), [0, 1, 2, 3, 8])
+        self.assertRaises(ValueError, cpu_list, "3-1")
+
+
+class TestCGroup(unittest.TestCase):
+    """Test `zdrun.CGroup` against a directory that looks like a cgroup."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        with open(os.path.join(self.root, 'cgroup.subtree_control'), 'w'):
+            pass
+
+    def testCreateEnablesControllers(self):
+        cgroup = zdrun.CGroup(os.path.join(self.root, 'app'))
+        # Creating the directory doesn't create interface files here.
+        self.assertRaises(FileNotFoundError, cgroup.create,
+                          [('memory.max', '100'), ('pids.max', '5')])
+        parent = zdrun.CGroup(self.root)
+        self.assertEqual(parent.read('cgroup.subtree_control'),
+                         '+memory +pids')
+        for name in 'memory.max', 'pids.max':
+            with open(os.path.join(cgroup.path, name), 'w') as f:
+                f.write('max\n')
+        cgroup.create([('memory.max', '100'), ('pids.max', '5')])
+        self.assertEqual(cgroup.read('memory.max'), '100')
+        self.assertEqual(cgroup.read('pids.max'), '5')
+
+    def testKillWithoutCGroupKill(self):
+        # Before Linux 5.14, each process is killed.
+        pid = os.fork()
+        if not pid:  # pragma: nocover
+            time.sleep(99)
+            os._exit(0)
+        cgroup = zdrun.CGroup(self.root)
+        with open(os.path.join(self.root, 'cgroup.procs'), 'w') as f:
+            f.write('%d\n' % pid)
+        cgroup.kill()
+        self.assertEqual(os.waitpid(pid, 0)[1], signal.SIGKILL)
+
+    def testStatsWithoutControllers(self):
+        self.assertEqual(set(zdrun.CGroup(self.root).stats().values()),
+                         {None})
+
+
+class TestProcessMemory(unittest.TestCase):
+
+    def testMetrics(self):
+        rss = zdrun.process_memory(os.getpid())
+        pss = zdrun.process_memory(os.getpid(), "pss")
+        self.assertGreater(rss, 1024 ** 2)
+        self.assertGreater(pss, 0)
+        self.assertLessEqual(pss, rss * 2)
+
+    def testNoSuchProcess(self):
+        pid = os.fork()
+        if not pid:  # pragma: nocover
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertIsNone(zdrun.process_memory(pid))
+
+
+class TestProbes(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = zdrun.Reactor()
+        self.results = []
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def tearDown(self):
+        self.reactor.close()
+
+    def probe(self, url, since=0, timeout=1):
+        probe = zdrun.make_probe(url, zdrun.probe_address(url), since,
+                                 self.reactor, timeout, self.results.append)
+        while not self.results:
+            self.reactor.run_once(1)
+        self.assertIsNone(probe.callback)
+        return self.results.pop()
+
+    def listen(self, family=socket.AF_INET, address=('127.0.0.1', 0)):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        sock.bind(address)
+        sock.listen(1)
+        return sock
+
+    def testTCP(self):
+        sock = self.listen()
+        url = 'tcp://127.0.0.1:%d' % sock.getsockname()[1]
+        self.assertTrue(self.probe(url))
+        sock.close()
+        self.assertFalse(self.probe(url))
+
+    def testTCPv6(self):
+        try:
+            sock = self.listen(socket.AF_INET6, ('::1', 0))
+        except OSError:  # pragma: nocover
+            self.skipTest("no IPv6 loopback")
+        url = 'tcp://[::1]:%d' % sock.getsockname()[1]
+        self.assertTrue(self.probe(url))
+
+    def testUnresolvable(self):
+        # Host names are resolved once, when the program is configured.
+        options = ConfiguredZDRunOptions(
+            "<runner>\n ready-probe tcp://nosuchhost.invalid:8080\n"
+            "</runner>\n")
+        options.realize(["true"])
+        stderr = StringIO()
+        with self.assertRaises(SystemExit), redirect_stderr(stderr):
+            zdrun.Subprocess(options)
+        self.assertIn("can't resolve ready probe", stderr.getvalue())
+
+    def testUnix(self):
+        path = os.path.join(self.tmp, 'sock')
+        url = 'unix://' + path
+        self.assertFalse(self.probe(url))
+        self.listen(socket.AF_UNIX, path)
+        self.assertTrue(self.probe(url))
+
+    def testHTTP(self):
+        sock = self.listen()
+        url = 'http://127.0.0.1:%d/health' % sock.getsockname()[1]
+        requests = []
+
+        def serve(status):
+            conn, addr = sock.accept()
+            with conn:
+                requests.append(conn.recv(1000))
+                conn.sendall(b'HTTP/1.0 ' + status + b' X\r\n\r\n')
+
+        for status, expected in ((b'200', True), (b'503', False)):
+            thread = threading.Thread(target=serve, args=(status,))
+            thread.start()
+            self.assertEqual(self.probe(url), expected)
+            thread.join()
+        self.assertTrue(requests[0].startswith(b'GET /health HTTP/1.0\r\n'))
+        self.assertIn(b'\r\nHost: 127.0.0.1:%d\r\n' % sock.getsockname()[1],
+                      requests[0])
+
+    def testFile(self):
+        path = os.path.join(self.tmp, 'ready')
+        url = 'file://' + path
+        self.assertFalse(self.probe(url))
+        with open(path, 'w'):
+            pass
+        self.assertTrue(self.probe(url, time.time() - 1))
+        # A file left over from before the start doesn't count.
+        self.assertFalse(self.probe(url, time.time() + 60))
+
+    def testTimeout(self):
+        # The listener never answers the request.
+        sock = self.listen()
+        url = 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+        self.assertFalse(self.probe(url, timeout=0.05))
+
+    def testCancel(self):
+        sock = self.listen()
+        url = 'tcp://127.0.0.1:%d' % sock.getsockname()[1]
+        probe = zdrun.make_probe(url, zdrun.probe_address(url), 0,
+                                 self.reactor, 1, self.results.append)
+        probe.cancel()
+        self.reactor.run_once(0.05)
+        self.assertEqual(self.results, [])
+        self.assertIsNone(probe.sock)
+
+
 def send_action(action, sockname, raise_on_error=False):
     """Send an action to the zdrun server and return the response.
 
@@ -454,4 +1139,16 @@ def test_suite():
             unittest.defaultTestLoader.loadTestsFromTestCase)
         suite.addTest(loadTestsFromTestCase(ZDaemonTests))
         suite.addTest(loadTestsFromTestCase(TestRunnerDirectory))
+        suite.addTest(loadTestsFromTestCase(TestReactor))
+        suite.addTest(loadTestsFromTestCase(TestControlConnection))
+        suite.addTest(loadTestsFromTestCase(TestStartupReport))
+        suite.addTest(loadTestsFromTestCase(TestTimeOptions))
+        suite.addTest(loadTestsFromTestCase(TestProbes))
+        suite.addTest(loadTestsFromTestCase(TestBackoff))
+        suite.addTest(loadTestsFromTestCase(TestRestartLimit))
+        suite.addTest(loadTestsFromTestCase(TestCPUAffinity))
+        suite.addTest(loadTestsFromTestCase(TestCGroup))
+        suite.addTest(loadTestsFromTestCase(TestProcessMemory))
+        suite.addTest(loadTestsFromTestCase(TestChildTracking))
+        suite.addTest(loadTestsFromTestCase(TestSpawnMethod))
     return suite
@@ -40,7 +40,9 @@ Actions are commands like "start", "stop" and "status".  Use the
 action "help" to find out about available actions.
 """
 
+import ast
 import cmd
+import json
 import os
 import os.path
 import re
@@ -70,6 +72,7 @@ if __name__ == "__main__":
             sys.path.insert(0, d)
             break
 
+from zdaemon.zdoptions import STATUS_VERSION
 from zdaemon.zdoptions import RunnerOptions
 from zdaemon.zdoptions import name2signal
 
@@ -90,8 +93,7 @@ class ZDCtlOptions(RunnerOptions):
                  default="schema.xml",
                  handler=self.set_schemafile)
         self.add("program", "runner.program", "p:", "program=",
-                 handler=string_list,
-                 required="no program specified; use -p or -C")
+                 handler=string_list)
         self.add("logfile", "runner.logfile", "l:", "logfile=")
         self.add("start_timeout", "runner.start_timeout",
                  "T:", "start-timeout=", int, default=300)
@@ -107,6 +109,11 @@ class ZDCtlOptions(RunnerOptions):
 
         RunnerOptions.realize(self, *args, **kwds)
 
+        # Program sections can take the place of the program option
+        self.programs = getattr(self.configroot, "programs", None) or []
+        if not self.program and not self.programs:
+            self.usage("no program specified; use -p or -C")
+
         # Maybe the config file requires -i or positional args
         if not self.args:
             self.usage("an action argument is required")
@@ -126,16 +133,15 @@ class ZDCmd(cmd.Cmd):
         self.prompt = self.options.prompt + ' '
         cmd.Cmd.__init__(self)
         self.get_status()
-        if self.zd_status:
-            m = re.search("(?m)^args=(.*)$", self.zd_status)
-            if m:
-                s = m.group(1)
-                args = eval(s, {"__builtins__": {}})
-                program = self.options.program
-                if args[:len(program)] != program:
-                    print("WARNING! zdrun is managing a different program!")
-                    print("our program   =", program)
-                    print("daemon's args =", args)
+        if self.zd_args is not None and self.options.program:
+            args = self.zd_args
+            # The status shows the arguments of the first instance
+            program = [arg.replace("%(instance)s", "0")
+                       for arg in self.options.program]
+            if args[:len(program)] != program:
+                print("WARNING! zdrun is managing a different program!")
+                print("our program   =", program)
+                print("daemon's args =", args)
 
         if options.configroot is not None:
             env = getattr(options.configroot, 'environment', None)
@@ -237,17 +243,37 @@ class ZDCmd(cmd.Cmd):
             sock.close()
 
     zd_testing = 0
+    zd_instances = ()
+    zd_selector = None  # Instance selector used by get_status
+    zd_args = None  # Arguments of the first selected subprocess
+    zd_document = None  # Parsed status --json reply, if there was one
+    zd_error = None  # Error reply to the status command, like a bad selector
 
     def get_status(self):
         self.zd_up = 0
         self.zd_pid = 0
         self.zd_should_be_up = 0
+        self.zd_testing = 0
         self.zd_status = None
-        resp = self.send_action("status")
+        self.zd_instances = []
+        self.zd_args = None
+        self.zd_document = None
+        self.zd_error = None
+        selector = self.zd_selector or ""
+        resp = self.send_action(("status --json " + selector).strip())
+        if not resp:
+            return resp
+        if self.parse_status_document(resp):
+            return resp
+        # The daemon manager predates status --json, or the selector was
+        # rejected; fall back to the legacy format.
+        resp = self.send_action(("status " + selector).strip())
         if not resp:
             return resp
         m = re.search(r"(?m)^application=(\d+)$", resp)
         if not m:
+            # The daemon manager is up, but rejected the command.
+            self.zd_error = resp.strip()
             return resp
         self.zd_up = 1
         self.zd_pid = int(m.group(1))
@@ -260,11 +286,65 @@ class ZDCmd(cmd.Cmd):
         m = re.search(r"(?m)^testing=(\d+)$", resp)
         if m:
             self.zd_testing = int(m.group(1))
-        else:
-            self.zd_testing = 0
+        m = re.search("(?m)^args=(.*)$", resp)
+        if m:
+            try:
+                self.zd_args = ast.literal_eval(m.group(1))
+            except (ValueError, SyntaxError):
+                pass
+        for m in re.finditer(r"(?m)^(?:program=\S+ )?"
+                             r"instance=(\d+) .*\bapplication=(\d+)"
+                             r" .*\btesting=(\d+)$", resp):
+            self.zd_instances.append(tuple(map(int, m.groups())))
 
         return resp
 
+    def parse_status_document(self, resp):
+        """Parse a status --json reply; return whether that worked."""
+        if not resp.startswith("{"):
+            return False
+        try:
+            document = json.loads(resp)
+        except ValueError:
+            return False
+        if document.get("version") != STATUS_VERSION:
+            return False
+        procs = document["processes"]
+        self.zd_up = 1
+        self.zd_status = resp
+        self.zd_document = document
+        self.zd_should_be_up = int(document["should_be_up"])
+        if procs:
+            self.zd_pid = procs[0]["pid"] or 0
+            self.zd_testing = int(procs[0]["testing"])
+            self.zd_args = procs[0]["args"]
+        self.zd_instances = [(proc["instance"], proc["pid"] or 0,
+                              int(proc["testing"]))
+                             for proc in procs]
+        return True
+
+    def report_error(self):
+        """Print the error reply get_status got, if any.
+
+        Return whether there was one.
+        """
+        if self.zd_error:
+            print(self.zd_error)
+            return True
+        return False
+
+    def _running_cond(self):
+        """Are all selected instances running and past their start test?"""
+        if not self.zd_pid or self.zd_testing:
+            return False
+        return all(pid and not testing
+                   for instance, pid, testing in self.zd_instances)
+
+    def _stopped_cond(self, n=0):
+        """Have all selected instances stopped?"""
+        return not self.zd_pid and not any(
+            pid for instance, pid, testing in self.zd_instances)
+
     def awhile(self, cond, msg):
         n = 0
         was_running = False
@@ -287,14 +367,54 @@ class ZDCmd(cmd.Cmd):
             print("^C")
         print("\n" + msg % self.__dict__)
 
+    def await_state(self, state, cond, msg, timeout=None):
+        """Wait until the selected processes reach `state`.
+
+        The daemon manager replies as soon as they do.  Daemon managers
+        that predate the wait command are polled with `awhile` and
+        `cond` instead.
+        """
+        action = "wait %s %s %s" % (
+            state, "-" if timeout is None else timeout,
+            self.zd_selector or "")
+        action = action.strip()
+        try:
+            resp = self.send_action(action)
+        except KeyboardInterrupt:
+            print("^C")
+            print("\n" + msg % self.__dict__)
+            return
+        if resp is None:
+            resp = ""  # The daemon manager isn't (or is no longer) up
+        resp = resp.strip()
+        if resp.startswith("Unknown command"):
+            return self.awhile(cond, msg)
+        self.get_status()
+        if resp.startswith("Timed out"):
+            # Only waits for starting processes have a timeout
+            print('\nProgram took too long to start')
+            sys.exit(1)
+        if not self.zd_up and state != "stopped":
+            print("\ndaemon manager not running")
+            return 1
+        if resp not in (state, ""):
+            print("\n" + resp)
+            return 1
+        print("\n" + msg % self.__dict__)
+
     def _start_cond(self, n):
         if (n > self.options.start_timeout):
             print('\nProgram took too long to start')
             sys.exit(1)
-        return self.zd_pid and not self.zd_testing
+        return self._running_cond()
 
     def do_start(self, arg):
+        # Without program sections, arguments are passed to the program
+        selector = arg if self.options.programs else ""
+        self.zd_selector = selector
         self.get_status()
+        if self.report_error():
+            return 1
         if not self.zd_up:
             if self.options.zdrun:
                 args = [self.options.python, self.options.zdrun]
@@ -315,21 +435,50 @@ class ZDCmd(cmd.Cmd):
             args += self._get_override(
                 "-x", "exitcodes", ",".join(map(str, self.options.exitcodes)))
             args += self._get_override("-z", "directory")
-            args.extend(self.options.program)
-            args.extend(self.options.args[1:])
+            if self.options.program:
+                args.extend(self.options.program)
+            if not self.options.programs:
+                args.extend(self.options.args[1:])
+            elif selector:
+                args.insert(2, "--start-only=" + selector)
             if self.options.daemon:
+                # The daemon manager tells us through a pipe when it's up
+                ready_r, ready_w = os.pipe()
+                os.set_inheritable(ready_w, True)
+                args.insert(2, "--ready-fd=%d" % ready_w)
                 flag = os.P_NOWAIT
             else:
                 flag = os.P_WAIT
             os.spawnvp(flag, args[0], args)
-        elif not self.zd_pid:
-            self.send_action("start")
+            if self.options.daemon:
+                os.close(ready_w)
+                if not self.read_startup(ready_r):
+                    print("daemon manager not running")
+                    return 1
+        elif not self.zd_pid or not all(
+                pid for instance, pid, testing in self.zd_instances):
+            self.send_action(("start " + selector).strip())
         else:
             print("daemon process already running; pid=%d" % self.zd_pid)
             return
         if self.options.daemon:
-            return self.awhile(
-                self._start_cond, "daemon process started, pid=%(zd_pid)d")
+            return self.await_state(
+                "running", self._start_cond,
+                "daemon process started, pid=%(zd_pid)d",
+                self.options.start_timeout)
+
+    def read_startup(self, fd):
+        """Read how a daemon manager we started fared; return if it's up.
+
+        The pipe is closed without a report if the daemon manager exits
+        before it's up; the reason, like a usage error, was already
+        written to stderr.
+        """
+        with os.fdopen(fd, "rb") as f:
+            report = f.readline().decode().strip()
+        if report.startswith("error: "):
+            print(report[len("error: "):])
+        return report == "ready"
 
     def _get_override(self, opt, name, svalue=None, flag=0):
         value = getattr(self.options, name)
@@ -359,22 +508,26 @@ class ZDCmd(cmd.Cmd):
         return args
 
     def help_start(self):
-        print("start -- Start the daemon process.")
-        print("         If it is already running, do nothing.")
+        print("start [selector ...] -- Start the daemon process.")
+        print("                        If it is already running, do nothing.")
 
     def do_stop(self, arg):
+        self.zd_selector = arg
         self.get_status()
+        if self.report_error():
+            return 1
         if not self.zd_up:
             print("daemon manager not running")
-        elif not self.zd_pid and not self.zd_should_be_up:
+        elif self._stopped_cond() and not self.zd_should_be_up:
             print("daemon process not running")
         else:
-            self.send_action("stop")
-            self.awhile(lambda n: not self.zd_pid, "daemon process stopped")
+            self.send_action(("stop " + arg).strip())
+            self.await_state(
+                "stopped", self._stopped_cond, "daemon process stopped")
 
     def help_stop(self):
-        print("stop -- Stop the daemon process.")
-        print("        If it is not running, do nothing.")
+        print("stop [selector ...] -- Stop the daemon process.")
+        print("                       If it is not running, do nothing.")
 
     def do_reopen_transcript(self, arg):
         if not self.zd_up:
@@ -387,25 +540,44 @@ class ZDCmd(cmd.Cmd):
         print("                     Use after log rotation.")
 
     def do_restart(self, arg):
+        selector = arg if self.options.programs else ""
+        self.zd_selector = selector
         self.get_status()
+        if self.report_error():
+            return 1
         pid = self.zd_pid
-        if not pid:
-            self.do_start(arg)
+        if not pid and not any(
+                ipid for instance, ipid, testing in self.zd_instances):
+            return self.do_start(arg)
         else:
-            self.send_action("restart")
-            self.awhile(lambda n: (self.zd_pid != pid) and self._start_cond(n),
-                        "daemon process restarted, pid=%(zd_pid)d")
+            self.send_action(("restart " + selector).strip())
+            self.await_state(
+                "running",
+                lambda n: (self.zd_pid != pid) and self._start_cond(n),
+                "daemon process restarted, pid=%(zd_pid)d",
+                self.options.start_timeout)
 
     def help_restart(self):
         print("restart -- Stop and then start the daemon process.")
 
     def do_kill(self, arg):
-        if not arg:
-            arg = 'SIGTERM'
+        args = arg.split()
+        if not args:
+            args = ['SIGTERM']
         try:
-            signame = name2signal(arg)
+            signame = name2signal(args[0])
         except ValueError:
-            print("invalid signal", repr(arg))
+            print("invalid signal", repr(args[0]))
+            return
+        if args[1:]:
+            # Let the daemon manager signal the selected instances
+            sig = getattr(signal, signame)
+            resp = self.send_action(
+                "kill %d %s" % (sig, " ".join(args[1:])))
+            if resp is None:
+                print("daemon manager not running")
+            else:
+                print(resp, end="")
             return
         self.get_status()
         if not self.zd_pid:
@@ -413,19 +585,23 @@ class ZDCmd(cmd.Cmd):
             return
         sig = getattr(signal, signame)
         print("kill(%d, %d)" % (self.zd_pid, sig))
-        try:
-            os.kill(self.zd_pid, sig)
-        except OSError as msg:
-            print("Error:", msg)
+        # The daemon manager signals the process group, if there is one
+        resp = self.send_action("kill %d" % sig)
+        if resp is None:
+            print("daemon manager not running")
+        elif not resp.startswith("Signal"):
+            print("Error:", resp.strip())
         else:
             print("signal %s sent to process %d" % (signame, self.zd_pid))
 
     def help_kill(self):
-        print("kill [sig] -- Send signal sig to the daemon process.")
-        print("              The default signal is SIGTERM.")
+        print("kill [sig] [selector ...] -- Send signal sig to the daemon"
+              " process.")
+        print("                             The default signal is SIGTERM.")
 
     def do_wait(self, arg):
-        self.awhile(lambda n: not self.zd_pid, "daemon process stopped")
+        self.await_state(
+            "stopped", self._stopped_cond, "daemon process stopped")
         self.do_status()
 
     def help_wait(self):
@@ -433,24 +609,71 @@ class ZDCmd(cmd.Cmd):
 
     def do_status(self, arg=""):
         status = 0
-        if arg not in ["", "-l"]:
-            print("status argument must be absent or -l")
+        args = arg.split()
+        long = args[:1] == ["-l"]
+        if long:
+            del args[0]
+        if args[:1] == ["--json"]:
+            # Print the document for scripts, whatever the state
+            resp = self.send_action(" ".join(["status"] + args))
+            if resp is None:
+                print("daemon manager not running")
+                return 3
+            print(resp, end="")
+            return 0 if resp.startswith("{") else 1
+        if any(a.startswith("-") for a in args):
+            print("status arguments must be absent or"
+                  " [-l | --json] [selector ...]")
             return 1
+        self.zd_selector = " ".join(args)
         self.get_status()
+        if self.report_error():
+            return 1
         if not self.zd_up:
             print("daemon manager not running")
             status = 3
         elif not self.zd_pid:
             print("daemon manager running; daemon process not running")
+            if self.zd_document and any(
+                    proc.get("circuit") == "open"
+                    for proc in self.zd_document["processes"]):
+                print("restarts suspended after too many restarts")
         else:
             print("program running; pid=%d" % self.zd_pid)
-        if arg == "-l" and self.zd_status:
-            print(self.zd_status)
+        if long and self.zd_up:
+            print(self.send_action(("status " + self.zd_selector).strip()))
         return status
 
     def help_status(self):
-        print("status [-l] -- Print status for the daemon process.")
-        print("               With -l, show raw status output as well.")
+        print("status [-l] [selector ...] -- Print status for the daemon"
+              " process.")
+        print("                              With -l, show raw status output"
+              " as well.")
+        print("                              With --json, print the status"
+              " as JSON.")
+
+    def do_subscribe(self, arg):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(self.options.sockname)
+            except OSError:
+                print("daemon manager not running")
+                return 3
+            sock.sendall(("subscribe " + arg).strip().encode() + b"\n")
+            # The stream ends when the daemon manager exits.
+            for line in sock.makefile():
+                print(line, end="")
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            print("^C")
+        finally:
+            sock.close()
+
+    def help_subscribe(self):
+        print("subscribe [selector ...] -- Print events as they happen.")
+        print("                            Events are JSON objects, one per"
+              " line.")
 
     def do_show(self, arg):
         if not arg:
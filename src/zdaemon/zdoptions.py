@@ -16,10 +16,16 @@
 import getopt
 import importlib.metadata
 import os
+import resource
 import signal
 import sys
+import urllib.parse
 
 import ZConfig
+import ZConfig.datatypes
+
+
+STATUS_VERSION = 1  # Version of the document returned by status --json
 
 
 class ZDOptions:
@@ -397,6 +403,271 @@ def octal_type(arg):
     return int(arg, 8)
 
 
+def child_tracking_mode(arg):
+    mode = arg.lower()
+    if mode not in ("auto", "pidfd", "sigchld"):
+        raise ValueError(
+            "child tracking must be auto, pidfd or sigchld, not %r" % arg)
+    return mode
+
+
+def spawn_method(arg):
+    method = arg.lower()
+    if method not in ("auto", "fork", "posix_spawn"):
+        raise ValueError(
+            "spawn method must be auto, fork or posix_spawn, not %r" % arg)
+    return method
+
+
+def restart_mode(arg):
+    mode = arg.lower()
+    if mode not in ("stop-first", "overlap"):
+        raise ValueError(
+            "restart mode must be stop-first or overlap, not %r" % arg)
+    return mode
+
+
+def seconds(arg):
+    """A non-negative number of seconds, possibly fractional."""
+    value = float(arg)
+    if not value >= 0:
+        raise ValueError("%r is not a non-negative number of seconds" % arg)
+    return value
+
+
+def positive_seconds(arg):
+    """A positive number of seconds, possibly fractional."""
+    value = float(arg)
+    if not value > 0:
+        raise ValueError("%r is not a positive number of seconds" % arg)
+    return value
+
+
+def backoff_multiplier(arg):
+    value = float(arg)
+    if not value >= 1:
+        raise ValueError("backoff multiplier must be at least 1, not %r"
+                         % arg)
+    return value
+
+
+def rlimit(arg, convert=int):
+    """Convert "SOFT" or "SOFT:HARD" to a (soft, hard) pair.
+
+    Either limit may be "unlimited".  The hard limit is None if it
+    isn't given.
+    """
+    def limit(value):
+        value = value.strip()
+        if value.lower() in ("unlimited", "infinity"):
+            return resource.RLIM_INFINITY
+        value = convert(value)
+        if value < 0:
+            raise ValueError("resource limits can't be negative")
+        return value
+
+    soft, colon, hard = arg.partition(":")
+    return limit(soft), (limit(hard) if colon else None)
+
+
+def rlimit_bytes(arg):
+    """Like `rlimit`, but the limits may be sizes like "512MB"."""
+    return rlimit(arg, ZConfig.datatypes.stock_datatypes["byte-size"])
+
+
+def oom_score_adj(arg):
+    value = int(arg)
+    if not -1000 <= value <= 1000:
+        raise ValueError("oom-score-adj must be between -1000 and 1000")
+    return value
+
+
+def cpu_list(arg):
+    """Convert a CPU list like "0-3,8" to a sorted list of CPU numbers."""
+    cpus = set()
+    for part in arg.split(","):
+        first, dash, last = part.strip().partition("-")
+        first = int(first)
+        last = int(last) if dash else first
+        if first < 0 or last < first:
+            raise ValueError("bad CPU range %r" % part)
+        cpus.update(range(first, last + 1))
+    return sorted(cpus)
+
+
+def fd_list(arg):
+    """Convert a list of file descriptors like "3 4,5" to a sorted list.
+
+    Standard input, output and error are always passed on, so they
+    can't be listed.
+    """
+    fds = set()
+    for part in arg.replace(",", " ").split():
+        fd = int(part)
+        if fd < 3:
+            raise ValueError("file descriptor %d can't be listed" % fd)
+        fds.add(fd)
+    return sorted(fds)
+
+
+def nice(arg):
+    value = int(arg)
+    if not -20 <= value <= 19:
+        raise ValueError("nice must be between -20 and 19")
+    return value
+
+
+IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+
+def ionice(arg):
+    """Convert "CLASS[:LEVEL]" to an (I/O class, level) pair.
+
+    The class is realtime, best-effort or idle; the level is 0 (the
+    highest priority) to 7, and defaults to 4.  The idle class has no
+    levels.
+    """
+    name, colon, level = arg.lower().partition(":")
+    if name not in IONICE_CLASSES:
+        raise ValueError(
+            "I/O class must be realtime, best-effort or idle, not %r" % name)
+    level = int(level) if colon else 4
+    if not 0 <= level <= 7:
+        raise ValueError("I/O priority level must be between 0 and 7")
+    if name == "idle":
+        level = 0
+    return name, level
+
+
+SCHEDULING_POLICIES = ("other", "batch", "idle", "fifo", "rr")
+
+
+def scheduling_policy(arg):
+    """Convert "POLICY[:PRIORITY]" to a (policy, priority) pair.
+
+    The policy is other, batch, idle, fifo or rr; only the real-time
+    policies, fifo and rr, have a priority, from 1 to 99.
+    """
+    name, colon, priority = arg.lower().partition(":")
+    if name not in SCHEDULING_POLICIES:
+        raise ValueError("scheduling policy must be one of %s, not %r"
+                         % (", ".join(SCHEDULING_POLICIES), name))
+    if name in ("fifo", "rr"):
+        priority = int(priority) if colon else 1
+        if not 1 <= priority <= 99:
+            raise ValueError("real-time priority must be between 1 and 99")
+    elif colon:
+        raise ValueError("only fifo and rr take a priority")
+    else:
+        priority = 0
+    return name, priority
+
+
+def cgroup_bytes(arg):
+    """A cgroup memory limit: "max" or a size like "512MB"."""
+    if arg.strip().lower() == "max":
+        return "max"
+    return str(ZConfig.datatypes.stock_datatypes["byte-size"](arg))
+
+
+def cgroup_cpu_max(arg):
+    """A cgroup cpu.max value: "max", "QUOTA [PERIOD]" or a percentage.
+
+    Quota and period are in microseconds; "150%" means one and a half
+    CPUs.
+    """
+    arg = arg.strip().lower()
+    if arg.endswith("%"):
+        percent = float(arg[:-1])
+        if percent <= 0:
+            raise ValueError("CPU percentage must be positive")
+        return "%d 100000" % round(percent * 1000)
+    words = arg.split()
+    if not 1 <= len(words) <= 2:
+        raise ValueError("cpu.max must be 'max', 'QUOTA [PERIOD]' or N%")
+    if words[0] != "max" and int(words[0]) <= 0:
+        raise ValueError("CPU quota must be positive")
+    if words[1:] and int(words[1]) <= 0:
+        raise ValueError("CPU period must be positive")
+    return " ".join(words)
+
+
+def cgroup_pids_max(arg):
+    """A cgroup pids.max value: "max" or a number of processes."""
+    if arg.strip().lower() == "max":
+        return "max"
+    value = int(arg)
+    if value < 0:
+        raise ValueError("pids.max can't be negative")
+    return str(value)
+
+
+def memory_metric(arg):
+    metric = arg.lower()
+    if metric not in ("rss", "pss"):
+        raise ValueError("memory metric must be rss or pss, not %r" % arg)
+    return metric
+
+
+def stop_signals(arg):
+    """Convert "SIGNAL[:TIMEOUT] ..." to a list of (signal, timeout) pairs.
+
+    Timeouts are in seconds; a missing one is None.
+    """
+    steps = []
+    for word in arg.split():
+        name, colon, timeout = word.partition(":")
+        sig = getattr(signal, name2signal(name))
+        steps.append((sig, seconds(timeout) if colon else None))
+    if not steps:
+        raise ValueError("stop-signals needs at least one signal")
+    return steps
+
+
+def probe_url(arg):
+    """Check a ready-probe URL.
+
+    Supported are tcp://HOST:PORT, unix:///PATH, http://HOST[:PORT]/PATH
+    and file:///PATH.  "%(instance)s" may occur anywhere.
+    """
+    url = urllib.parse.urlsplit(arg.replace("%(instance)s", "0"))
+    if url.scheme not in ("tcp", "unix", "http", "file"):
+        raise ValueError(
+            "ready probe must be a tcp, unix, http or file URL, not %r" % arg)
+    if url.scheme in ("tcp", "http"):
+        port = url.port  # raises ValueError if it's not a number
+        if not url.hostname or (port is None and url.scheme == "tcp"):
+            raise ValueError("ready probe %r needs a host and port" % arg)
+    elif not url.path:
+        raise ValueError("ready probe %r needs a path" % arg)
+    return arg
+
+
+def listen_addresses(arg):
+    """Convert a list of listen addresses to (name, URL) pairs.
+
+    Addresses are tcp://HOST:PORT or unix:///PATH URLs, optionally
+    preceded by a name and "=", as in "http=tcp://:8080".  Unnamed
+    addresses are named "unknown", as with systemd.
+    """
+    addresses = []
+    for part in arg.split():
+        name, eq, address = part.partition("=")
+        if not eq or "://" in name:
+            name, address = "unknown", part
+        elif not name or ":" in name:
+            raise ValueError("bad listen address name %r" % name)
+        url = urllib.parse.urlsplit(address)
+        if url.scheme == "tcp":
+            if url.port is None:  # raises ValueError if it's not a number
+                raise ValueError("listen address %r needs a port" % address)
+        elif url.scheme != "unix" or not url.path:
+            raise ValueError("listen address must be a tcp://HOST:PORT or"
+                             " unix:///PATH URL, not %r" % address)
+        addresses.append((name, address))
+    return addresses
+
+
 def name2signal(string):
     """Converts a signal name to canonical form.
 
@@ -17,17 +17,29 @@
 Usage: python zrdun.py [zrdun-options] program [program-arguments]
 """
 
+import array
+import collections
+import copy
 import errno
 import fcntl
+import functools
+import heapq
+import json
 import logging
 import os
+import random
+import resource
 import select
+import selectors
 import signal
 import socket
+import struct
 import subprocess
 import sys
 import threading
 import time
+import urllib.parse
+from stat import S_ISSOCK
 from stat import ST_MODE
 
 
@@ -52,6 +64,8 @@ if __name__ == "__main__":
 
 from ZConfig.components.logger.loghandler import reopenFiles
 
+from zdaemon.zdoptions import IONICE_CLASSES
+from zdaemon.zdoptions import STATUS_VERSION
 from zdaemon.zdoptions import RunnerOptions
 
 
@@ -59,6 +73,20 @@ def string_list(arg):
     return arg.split()
 
 
+# The cgroup interface files set by the cgroup-* options
+CGROUP_LIMITS = ("memory.max", "memory.high", "cpu.max", "pids.max")
+
+# The resource limits set by the rlimit-* options
+RLIMITS = (
+    ("nofile", "RLIMIT_NOFILE"),
+    ("nproc", "RLIMIT_NPROC"),
+    ("as", "RLIMIT_AS"),
+    ("rss", "RLIMIT_RSS"),
+    ("core", "RLIMIT_CORE"),
+    ("cpu", "RLIMIT_CPU"),
+)
+
+
 class ZDRunOptions(RunnerOptions):
 
     __doc__ = __doc__
@@ -66,6 +94,7 @@ class ZDRunOptions(RunnerOptions):
     positional_args_allowed = 1
     logsectionname = "runner.eventlog"
     program = None
+    programs = ()  # ProgramOptions of named programs
 
     def __init__(self):
         RunnerOptions.__init__(self)
@@ -73,7 +102,54 @@ class ZDRunOptions(RunnerOptions):
                  default="schema.xml",
                  handler=self.set_schemafile)
         self.add("stoptimeut", "runner.stop_timeout")
+        self.add("stopsignals", "runner.stop_signals")
+        self.add("processgroup", "runner.process_group", default=False)
+        self.add("backoffinitial", "runner.backoff_initial", default=1.0)
+        self.add("backoffmultiplier", "runner.backoff_multiplier")
+        self.add("backoffmax", "runner.backoff_max")
+        self.add("backoffjitter", "runner.backoff_jitter", default=0.0)
+        self.add("backoffreset", "runner.backoff_reset")
+        self.add("restartlimit", "runner.restart_limit", default=0)
+        self.add("restartwindow", "runner.restart_window", default=60.0)
+        self.add("circuitopentime", "runner.circuit_open_time",
+                 default=60.0)
+        self.add("restartmode", "runner.restart_mode", default="stop-first")
         self.add("starttestprogram", "runner.start_test_program")
+        self.add("childtracking", "runner.child_tracking", default="auto")
+        self.add("subreaper", "runner.subreaper", default=False)
+        self.add("spawnmethod", "runner.spawn_method", default="auto")
+        self.add("passfds", "runner.pass_fds", default=())
+        self.add("listen", "runner.listen", default=())
+        self.add("listenbacklog", "runner.listen_backlog", default=128)
+        self.add("listenreuseport", "runner.listen_reuseport", default=False)
+        self.add("fdstoremax", "runner.fd_store_max", default=0)
+        self.add("numprocs", "runner.numprocs", default=1)
+        self.add("settletime", "runner.settle_time", default=0.0)
+        self.add("readyprobe", "runner.ready_probe")
+        self.add("probeinterval", "runner.probe_interval", default=0.25)
+        self.add("probetimeout", "runner.probe_timeout", default=1.0)
+        self.add("notify", "runner.notify", default=False)
+        self.add("watchdogtimeout", "runner.watchdog_timeout", default=0)
+        for key, name in RLIMITS:
+            self.add("rlimit" + key, "runner.rlimit_" + key)
+        self.add("oomscoreadj", "runner.oom_score_adj")
+        self.add("cpuaffinity", "runner.cpu_affinity")
+        self.add("cpusperinstance", "runner.cpus_per_instance", default=0)
+        self.add("nice", "runner.nice")
+        self.add("ionice", "runner.ionice")
+        self.add("schedulingpolicy", "runner.scheduling_policy")
+        self.add("memorylimit", "runner.memory_limit")
+        self.add("memorymetric", "runner.memory_metric", default="rss")
+        self.add("memorycheckinterval", "runner.memory_check_interval",
+                 default=10.0)
+        self.add("memorygrace", "runner.memory_grace", default=60.0)
+        self.add("memorycooldown", "runner.memory_cooldown", default=300.0)
+        self.add("cgroup", "runner.cgroup")
+        for key in CGROUP_LIMITS:
+            self.add("cgroup" + key.replace(".", ""),
+                     "runner.cgroup_" + key.replace(".", "_"))
+        self.add("readyfd", None, None, "ready-fd=", int)
+        self.add("startonly", None, None, "start-only=")
 
     def set_schemafile(self, file):
         self.schemafile = file
@@ -82,8 +158,17 @@ class ZDRunOptions(RunnerOptions):
         RunnerOptions.realize(self, *args, **kwds)
         if self.args:
             self.program = self.args
-        if not self.program:
+        # Not every schema using the runner section has program sections
+        sections = getattr(self.configroot, "programs", None) or ()
+        self.programs = [ProgramOptions(self, section)
+                         for section in sections]
+        if not self.program and not self.programs:
             self.usage("no program specified (use positional args)")
+        if self.numprocs < 1:
+            self.usage("numprocs must be at least 1")
+        if self.readyfd is not None:
+            # Our subprocesses have no business with it
+            os.set_inheritable(self.readyfd, False)
         if self.sockname:
             # Convert socket name to absolute path
             self.sockname = os.path.abspath(self.sockname)
@@ -94,6 +179,21 @@ class ZDRunOptions(RunnerOptions):
         else:
             self.logger = self.config_logger()
 
+    def reportstartup(self, msg):
+        """Tell zdctl, through the --ready-fd pipe, how startup went.
+
+        Only the first report counts; zdctl stops reading after it.
+        """
+        fd = self.readyfd
+        if fd is None:
+            return
+        self.readyfd = None
+        try:
+            os.write(fd, msg.encode() + b"\n")
+        except OSError:
+            pass
+        os.close(fd)
+
     def load_logconf(self, sectname):
         """Load alternate eventlog if the specified section isn't present."""
         RunnerOptions.load_logconf(self, sectname)
@@ -101,29 +201,112 @@ class ZDRunOptions(RunnerOptions):
             RunnerOptions.load_logconf(self, "eventlog")
 
 
+class ProgramOptions:
+
+    """Options for a named program section.
+
+    Options describing the program and its supervision are read from
+    the program section.  Everything else, like the socket name or the
+    logger, comes from the daemon manager's options.
+    """
+
+    # Options that only make sense for the daemon manager as a whole
+    manager_attrs = ("daemon", "sockname", "user", "umask", "directory",
+                     "childtracking", "subreaper")
+
+    def __init__(self, options, section):
+        self.manager_options = options
+        self.name = section.getSectionName()
+        for name, confname in options.names_list:
+            if (name in self.manager_attrs or not confname
+                    or not confname.startswith("runner.")):
+                continue
+            value = getattr(section, confname.split(".", 1)[1], None)
+            if value is None:
+                value = options.default_map.get(name)
+            setattr(self, name, value)
+        self.program = self.args = section.program
+        if not self.program:
+            self.usage("no program specified for %r" % self.name)
+        if self.numprocs < 1:
+            self.usage("numprocs must be at least 1 for %r" % self.name)
+
+    def __getattr__(self, name):
+        return getattr(self.manager_options, name)
+
+
 class Subprocess:
 
     """A class to manage a subprocess."""
 
     # Initial state; overridden by instance variables
     pid = 0  # Subprocess pid; 0 when not running
+    pidfd = None  # Process file descriptor watching pid, if used
     lasttime = 0  # Last time the subprocess was started; 0 if never
-
-    def __init__(self, options, args=None, child_exits=None):
+    should_be_up = True  # Whether the subprocess should be running
+    backoff = 0  # Current restart delay in seconds, without jitter
+    failures = 0  # Quick exits in a row, counted against backofflimit
+    circuitopen = False  # Whether restarts are suspended by restartlimit
+    cgroup = None  # If set, the CGroup the subprocess runs in
+    memorycheck = None  # If set, a Timer; memory use is sampled when it fires
+    memory = None  # Last sampled memory use in bytes
+    overlimitsince = None  # Monotonic time since memory use exceeds the limit
+    recycles = 0  # How often the subprocess was restarted for memory use
+    lastrecycle = None  # (time, memory use) of the last such restart
+    recycledat = None  # Monotonic time of the last such restart
+    delay = None  # If set, a Timer delaying starting or killing
+    killing = 0  # If true, the step of stop_steps() being taken, from 1
+    name = None  # Used in log messages to tell instances apart
+    program = None  # The Program this is an instance of
+    restarts = 0  # How often the subprocess was started again
+    lastexit = None  # (time, status) of the subprocess's last exit
+    onready = None  # Called with the pid by the test thread when done
+    settling = None  # If set, a Timer; the subprocess is started when it fires
+    probe = None  # The running ready Probe, or a Timer for the next one
+    probeaddress = None  # (family, address) the ready probe connects to
+    output = None  # If set, fd to send the subprocess's output to
+    environment = None  # If set, variables to add to the environment
+    watchdog = None  # If set, a Timer; the subprocess hangs when it fires
+    statustext = None  # Last STATUS= sent by the subprocess with sd_notify
+    stopping = False  # Whether the subprocess sent STOPPING=1
+    lingering = None  # Process group id while members outlive the subprocess
+    groupcheck = None  # If set, a Timer; the group is checked when it fires
+    cleanup = False  # Whether the lingering group is stopped after a crash
+    listeners = ()  # (name, socket) pairs passed on with LISTEN_FDS
+    fdstore = ()  # (name, fd) pairs stored by the subprocess, passed on, too
+    generation = 0  # How often the subprocess was started
+    successor = None  # For a retiring generation, the Subprocess replacing it
+
+    def __init__(self, options, args=None, child_exits=None, instance=0):
         """Constructor.
 
         Arguments are a ZDRunOptions instance and a list of program
         arguments; the latter's first item must be the program name.
+        Occurrences of "%(instance)s" in the arguments are replaced by
+        the instance number.
         """
         if args is None:
             args = options.args
         if not args:
             options.usage("missing 'program' argument")
         self.options = options
-        self.args = args
+        self.instance = instance
+        self.args = self.substitute(args)
         self.testing = set()
+        self.restarttimes = collections.deque()  # Within restartwindow
+        self.fdstore = []
+        if options.cgroup:
+            self.cgroup = CGroup(self.substitute([options.cgroup])[0])
         self.child_exits = child_exits
         self._set_filename(args[0])
+        if options.readyprobe:
+            # Once, rather than by every probe in the event loop
+            url = self.substitute([options.readyprobe])[0]
+            try:
+                self.probeaddress = probe_address(url)
+            except OSError as err:
+                options.usage("can't resolve ready probe %r: %s" % (url, err))
+        self.useposixspawn = self.choosespawnmethod()
 
     def _set_filename(self, program):
         """Internal: turn a program name into a file name, using $PATH."""
@@ -151,8 +334,12 @@ class Subprocess:
             self.options.usage("no permission to run program %r" % filename)
         self.filename = filename
 
+    def substitute(self, args):
+        instance = str(self.instance)
+        return [arg.replace("%(instance)s", instance) for arg in args]
+
     def test(self, pid):
-        starttestprogram = self.options.starttestprogram
+        starttestprogram = self.substitute(self.options.starttestprogram)
         logger = self.options.logger
         try:
             while self.pid == pid:
@@ -179,39 +366,189 @@ class Subprocess:
                 time.sleep(1)
         finally:
             self.testing.remove(pid)
+            if self.onready is not None:
+                self.onready(pid)
 
     def spawn(self):
         """Start the subprocess.  It must not be running already.
 
-        Return the process id.  If the fork() call fails, return 0.
+        Return the process id.  If the fork() or posix_spawn() call
+        fails, return 0.
         """
         assert not self.pid
         self.lasttime = time.time()
-        try:
-            pid = os.fork()
-        except OSError:
-            return 0
-        if pid != 0:
-            # Parent
+        if self.useposixspawn:
+            pid = self.posixspawn()
+        else:
+            pid = self.forkexec()
+        if pid:
             self.pid = pid
-            if self.options.starttestprogram:
+            if (self.options.starttestprogram and not self.options.readyprobe
+                    and not self.options.notify):
                 self.testing.add(pid)
                 thread = threading.Thread(target=self.test, args=(pid,))
                 thread.setDaemon(True)
                 thread.start()
 
-            self.options.logger.info("spawned process pid=%d", pid)
+            if self.name:
+                self.options.logger.info(
+                    "spawned %s process pid=%d", self.name, pid)
+            else:
+                self.options.logger.info("spawned process pid=%d", pid)
+        return pid
+
+    def retire(self):
+        """Hand the running process over to a copy of this Subprocess.
+
+        The copy tracks the process until it exits, while this one
+        starts the next generation.  Return the copy.
+        """
+        old = copy.copy(self)
+        old.successor = self
+        old.should_be_up = False
+        old.testing = set()
+        old.restarttimes = collections.deque()
+        old.fdstore = []
+        old.cgroup = None  # Killing it would kill the next generation
+        self.pid = 0
+        self.pidfd = None
+        return old
+
+    def resume(self, old):
+        """Take the running process back from a retiring copy."""
+        for name in ("pid", "pidfd", "lasttime", "generation",
+                     "statustext", "stopping"):
+            setattr(self, name, getattr(old, name))
+
+    def forkspawnreasons(self):
+        """Return the options that need the program to be forked.
+
+        These are applied by code run in the child before exec, which
+        posix_spawn() can't do.
+        """
+        options = self.options
+        reasons = []
+        if self.cgroup is not None:
+            reasons.append("cgroup")
+        for key, name in RLIMITS:
+            if getattr(options, "rlimit" + key) is not None:
+                reasons.append("rlimit-" + key)
+        for attr, key in (("oomscoreadj", "oom-score-adj"),
+                          ("cpuaffinity", "cpu-affinity"),
+                          ("schedulingpolicy", "scheduling-policy"),
+                          ("nice", "nice"),
+                          ("ionice", "ionice")):
+            if getattr(options, attr) is not None:
+                reasons.append(key)
+        if options.notify and options.watchdogtimeout:
+            # WATCHDOG_PID must be set to the pid before exec
+            reasons.append("watchdog-timeout")
+        if options.listen:
+            # So must LISTEN_PID
+            reasons.append("listen")
+        if options.fdstoremax:
+            reasons.append("fd-store-max")
+        return reasons
+
+    def choosespawnmethod(self):
+        """Return whether the program is started with posix_spawn()."""
+        method = self.options.spawnmethod
+        if method == "fork":
+            return False
+        reasons = self.forkspawnreasons()
+        if method == "posix_spawn":
+            if not hasattr(os, "posix_spawn"):
+                self.options.usage("posix_spawn is not supported here")
+            if reasons:
+                self.options.usage("posix_spawn can't be used with "
+                                   + ", ".join(reasons))
+        return hasattr(os, "posix_spawn") and not reasons
+
+    def posixspawn(self):
+        """Start the program with os.posix_spawn(); return its pid or 0.
+
+        The C library may use vfork() or clone(CLONE_VM), so, unlike
+        fork(), this doesn't copy the page tables of the manager.
+
+        posix_spawn() reports a failed exec to the caller.  Then, the
+        program is started with forkexec() instead, so that the failure
+        is reported like there, by a child that writes why to the
+        transcript and exits with status 127, which the restart policy
+        counts.
+        """
+        actions = []
+        if self.output is not None:
+            actions.append((os.POSIX_SPAWN_DUP2, self.output, 1))
+            actions.append((os.POSIX_SPAWN_DUP2, self.output, 2))
+        # Close what would leak into the program, like forkexec() does;
+        # the others are close-on-exec.
+        passfds = self.options.passfds
+        for fd in inheritable_fds():
+            if fd not in passfds:
+                actions.append((os.POSIX_SPAWN_CLOSE, fd))
+        env = os.environ
+        if self.environment is not None:
+            env = dict(env, **self.environment)
+        kw = {}
+        if self.options.processgroup:
+            kw["setpgroup"] = 0
+        try:
+            return os.posix_spawn(self.filename, self.args, env,
+                                  file_actions=actions, **kw)
+        except OSError as err:
+            self.options.logger.warning(
+                "can't spawn %r: %s; trying fork and exec",
+                self.filename, err)
+            return self.forkexec()
+
+    def forkexec(self):
+        """Start the program with fork() and exec; return its pid or 0."""
+        try:
+            pid = os.fork()
+        except OSError:
+            return 0
+        if pid != 0:
+            # Parent
+            if self.options.processgroup:
+                try:
+                    # Also done by the child; whoever comes first wins.
+                    os.setpgid(pid, pid)
+                except OSError:
+                    pass
             return pid
         else:  # pragma: nocover
             # Child
             try:
-                # Close file descriptors except std{in,out,err}.
-                # XXX We don't know how many to close; hope 100 is plenty.
-                for i in range(3, 100):
-                    try:
-                        os.close(i)
-                    except OSError:
-                        pass
+                if self.output is not None:
+                    os.dup2(self.output, 1)
+                    os.dup2(self.output, 2)
+                if self.environment is not None:
+                    os.environ.update(self.environment)
+                    if "WATCHDOG_USEC" in self.environment:
+                        os.environ["WATCHDOG_PID"] = str(os.getpid())
+                try:
+                    if self.options.processgroup:
+                        os.setpgid(0, 0)
+                    if self.cgroup is not None:
+                        # Before exec, so even early children are in it
+                        self.cgroup.join(os.getpid())
+                    listenfds = self.listenfds()
+                    if listenfds:
+                        self.placelistenfds(listenfds)
+                    self.setlimits()
+                    self.setscheduling()
+                except (OSError, ValueError) as err:
+                    sys.stderr.write("can't set up the process: %s\n" % err)
+                    sys.stderr.flush()
+                    os._exit(127)
+                # Close file descriptors except std{in,out,err} and
+                # those to pass on.  On Linux, each range is closed by a
+                # single close_range() call.
+                low = 3 + len(self.listenfds())
+                for fd in self.options.passfds:
+                    os.closerange(low, fd)
+                    low = fd + 1
+                os.closerange(low, MAXFD)
                 try:
                     os.execv(self.filename, self.args)
                 except OSError as err:
@@ -222,16 +559,135 @@ class Subprocess:
                 os._exit(127)
             # Does not return
 
+    def listenfds(self):
+        """Return the (name, fd) pairs to pass on with LISTEN_FDS.
+
+        These are the listening sockets, then the stored descriptors.
+        """
+        return ([(name, sock.fileno()) for name, sock in self.listeners]
+                + self.fdstore)
+
+    def placelistenfds(self, listenfds):
+        """Pass descriptors on as systemd does.
+
+        They are moved to file descriptors 3 and up, and LISTEN_FDS,
+        LISTEN_PID and LISTEN_FDNAMES are set.  This is called in the
+        child, before exec.
+        """
+        count = len(listenfds)
+        # Copy them out of the way first, so none is overwritten.
+        floor = max([3 + count] + [fd + 1 for fd in self.options.passfds])
+        fds = [fcntl.fcntl(fd, fcntl.F_DUPFD, floor)
+               for name, fd in listenfds]
+        for i, fd in enumerate(fds):
+            os.dup2(fd, 3 + i)
+        os.environ["LISTEN_FDS"] = str(count)
+        os.environ["LISTEN_PID"] = str(os.getpid())
+        os.environ["LISTEN_FDNAMES"] = ":".join(
+            name for name, fd in listenfds)
+
+    def setlimits(self):
+        """Apply the configured resource limits to the current process.
+
+        This is called in the child, before exec.  A soft limit given
+        without a hard limit keeps the current hard limit, unless it's
+        lower.
+        """
+        for key, name in RLIMITS:
+            limits = getattr(self.options, "rlimit" + key)
+            if limits is None:
+                continue
+            which = getattr(resource, name, None)
+            if which is None:
+                raise ValueError("%s isn't supported here" % name)
+            soft, hard = limits
+            if hard is None:
+                hard = resource.getrlimit(which)[1]
+                if hard != resource.RLIM_INFINITY and (
+                        soft == resource.RLIM_INFINITY or soft > hard):
+                    hard = soft
+            try:
+                resource.setrlimit(which, (soft, hard))
+            except (OSError, ValueError) as err:
+                raise ValueError("%s %s: %s" % (name, limits, err))
+        if self.options.oomscoreadj is not None:
+            with open("/proc/self/oom_score_adj", "w") as f:
+                f.write("%d\n" % self.options.oomscoreadj)
+
+    def cgrouplimits(self):
+        """Return (interface file, value) pairs for the cgroup."""
+        limits = []
+        for key in CGROUP_LIMITS:
+            value = getattr(self.options, "cgroup" + key.replace(".", ""))
+            if value is not None:
+                limits.append((key, value))
+        return limits
+
+    @property
+    def ownscgroup(self):
+        """Whether the subprocess is alone in its cgroup.
+
+        Then, killing the cgroup kills just the subprocess and any
+        processes it started.
+        """
+        return self.cgroup is not None and (
+            "%(instance)s" in self.options.cgroup
+            or self.options.numprocs == 1)
+
+    def cpus(self):
+        """Return the CPUs the subprocess may run on, or None for any.
+
+        With cpusperinstance, instances get consecutive slices of the
+        cpuaffinity list, wrapping around at its end.
+        """
+        cpus = self.options.cpuaffinity
+        count = self.options.cpusperinstance
+        if cpus and count:
+            start = self.instance * count
+            cpus = sorted(cpus[(start + i) % len(cpus)]
+                          for i in range(min(count, len(cpus))))
+        return cpus
+
+    def setscheduling(self):
+        """Apply the configured CPU and I/O scheduling settings.
+
+        This is called in the child, before exec.
+        """
+        options = self.options
+        cpus = self.cpus()
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        if options.schedulingpolicy is not None:
+            name, priority = options.schedulingpolicy
+            policy = getattr(os, "SCHED_" + name.upper(), None)
+            if policy is None:
+                raise ValueError("scheduling policy %r isn't supported here"
+                                 % name)
+            os.sched_setscheduler(0, policy, os.sched_param(priority))
+        if options.nice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, options.nice)
+        if options.ionice is not None:
+            ioprio_set(*options.ionice)
+
     def kill(self, sig):
         """Send a signal to the subprocess.  This may or may not kill it.
 
         Return None if the signal was sent, or an error message string
         if an error occurred or if the subprocess is not running.
         """
-        if not self.pid:
+        pgid = self.lingering
+        if self.pid and self.options.processgroup:
+            pgid = self.pid
+        if not self.pid and not pgid:
             return "no subprocess running"
         try:
-            os.kill(self.pid, sig)
+            if sig == signal.SIGKILL and self.ownscgroup:
+                # Leave no processes started by the subprocess behind.
+                self.cgroup.kill()
+            elif pgid:
+                os.killpg(pgid, sig)
+            else:
+                os.kill(self.pid, sig)
         except OSError as msg:
             return str(msg)
         return None
@@ -245,6 +701,165 @@ class Subprocess:
         self.pid = 0
 
 
+class Program:
+
+    """The instances of a program supervised by the daemon manager.
+
+    The program named None is the one given by the runner section or
+    the positional arguments; the others come from program sections.
+    """
+
+    transcript = None  # ProgramTranscript, if the program has its own
+
+    def __init__(self, options, name=None, child_exits=None):
+        self.options = options
+        self.name = name
+        self.procs = []
+        for instance in range(options.numprocs):
+            proc = Subprocess(options, child_exits=child_exits,
+                              instance=instance)
+            proc.program = self
+            if name is None:
+                if options.numprocs > 1:
+                    proc.name = "instance %d" % instance
+            elif options.numprocs > 1:
+                proc.name = "%s:%d" % (name, instance)
+            else:
+                proc.name = name
+            self.procs.append(proc)
+
+    def opentranscript(self, reactor):
+        self.transcript = ProgramTranscript(self.options.transcript, reactor)
+        for proc in self.procs:
+            proc.output = self.transcript.write_to
+
+
+class Timer:
+
+    """A callback scheduled by a `Reactor`.
+
+    `when` is a `time.monotonic` value.  A timer is active until it
+    fires or is cancelled.
+    """
+
+    active = True
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        self.active = False
+
+    def wallclock(self):
+        """Return the deadline expressed as a `time.time` value."""
+        return time.time() + self.when - time.monotonic()
+
+
+class Reactor:
+
+    """The daemon manager's event loop.
+
+    File descriptors are watched with a `selectors` selector (epoll on
+    Linux) and deadlines are kept in a heap of `Timer` objects ordered
+    by `time.monotonic`, so that stepping the system clock neither
+    shortens nor stretches them.  Callbacks are called without
+    arguments (I/O) or with the arguments given when scheduling them
+    (timers).
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        # Other threads hand calls over through a queue and wake up the
+        # loop by writing to a pipe.
+        self.calls = collections.deque()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.register(self.wakeup_r, self.runcalls)
+
+    def time(self):
+        return time.monotonic()
+
+    def register(self, fileobj, callback, events=selectors.EVENT_READ):
+        self.selector.register(fileobj, events, callback)
+
+    def modify(self, fileobj, callback, events):
+        self.selector.modify(fileobj, events, callback)
+
+    def unregister(self, fileobj):
+        try:
+            self.selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Have the loop call `callback`; safe to use from any thread."""
+        self.calls.append((callback, args))
+        try:
+            os.write(self.wakeup_w, b"x")
+        except BlockingIOError:  # pragma: nocover
+            pass  # The loop has plenty of wakeups pending already.
+
+    def runcalls(self):
+        try:
+            os.read(self.wakeup_r, 512)
+        except BlockingIOError:  # pragma: nocover
+            pass
+        while self.calls:
+            callback, args = self.calls.popleft()
+            callback(*args)
+
+    def timeout(self):
+        """Return seconds until the next active timer, or None."""
+        timers = self.timers
+        while timers and not timers[0].active:
+            heapq.heappop(timers)
+        if not timers:
+            return None
+        return max(0, timers[0].when - self.time())
+
+    def run_once(self, timeout=None):
+        """Wait for I/O or a timer and dispatch whatever is ready.
+
+        If `timeout` is given, don't block for longer than that.
+        """
+        pending = self.timeout()
+        if pending is not None and (timeout is None or pending < timeout):
+            timeout = pending
+        ready = self.selector.select(timeout)
+        fd_map = self.selector.get_map()
+        for key, mask in ready:
+            # An earlier callback may have unregistered this one.
+            if fd_map.get(key.fd) is key:
+                key.data()
+        now = self.time()
+        timers = self.timers
+        while timers and (timers[0].when <= now or not timers[0].active):
+            timer = heapq.heappop(timers)
+            if timer.active:
+                timer.active = False
+                timer.callback(*timer.args)
+
+    def close(self):
+        self.selector.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+
 class Daemonizer:
 
     def main(self, args=None):
@@ -255,24 +870,56 @@ class Daemonizer:
 
     def run(self):
         self.child_exits = _ChildExits()
-        self.proc = Subprocess(self.options, child_exits=self.child_exits)
+        self.programs = []
+        if self.options.program:
+            self.programs.append(
+                Program(self.options, child_exits=self.child_exits))
+        for options in self.options.programs:
+            self.programs.append(
+                Program(options, options.name, self.child_exits))
+        self.programsbyname = {program.name: program
+                               for program in self.programs}
+        self.procs = [proc
+                      for program in self.programs
+                      for proc in program.procs]
+        self.proc = self.procs[0]
+        if self.options.startonly:
+            # zdctl starting us for "start selector ..."
+            try:
+                selected = self.chooseprocs(self.options.startonly.split())
+            except ValueError as err:
+                self.options.usage(str(err))
+            for proc in self.procs:
+                proc.should_be_up = proc in selected
+        self.usepidfd = self.choosechildtracking()
+        self.setinheritance()
         self.opensocket()
+        notifyprocs = [proc for proc in self.procs
+                       if proc.options.notify or proc.options.fdstoremax]
+        if notifyprocs:
+            self.opennotifysocket(notifyprocs)
         try:
+            self.openlisteners()
             self.setsignals()
             if self.options.daemon:
                 self.daemonize()
+            if self.options.subreaper:
+                self.becomesubreaper()
             try:
                 self.runforever()
-            except Exception:  # pragma: nocover
+            except Exception as err:  # pragma: nocover
                 self.logger.critical("runforever raised", exc_info=True)
+                self.options.reportstartup("error: %s" % err)
         finally:
             try:
                 os.unlink(self.options.sockname)
             except OSError:
                 pass
+            if self.notifysocket is not None:
+                self.unlink_quietly(self.notifysocket.getsockname())
+            self.closelisteners()
 
     mastersocket = None
-    commandsocket = None
 
     def opensocket(self):
         sockname = self.options.sockname
@@ -300,14 +947,75 @@ class Daemonizer:
                     continue
             finally:
                 self.unlink_quietly(tempname)
-        sock.listen(1)
+        sock.listen(16)
         sock.setblocking(0)
-        try:  # PEP 446, Python >= 3.4
-            sock.set_inheritable(True)
-        except AttributeError:
-            pass
         self.mastersocket = sock
 
+    notifysocket = None  # Datagram socket named by NOTIFY_SOCKET, if used
+
+    def opennotifysocket(self, procs):
+        """Bind the socket the subprocesses send sd_notify messages to.
+
+        The name is absolute, as both we and the subprocesses may
+        change directories.  Where the platform supports it, the
+        kernel tells us the pid of the sender of each message.
+        """
+        sockname = os.path.abspath(self.options.sockname + ".notify")
+        self.unlink_quietly(sockname)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(sockname)
+        os.chmod(sockname, 0o700)
+        sock.setblocking(False)
+        if hasattr(socket, "SO_PASSCRED"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_PASSCRED, 1)
+        self.notifysocket = sock
+        for proc in procs:
+            proc.environment = {"NOTIFY_SOCKET": sockname}
+            if proc.options.watchdogtimeout:
+                proc.environment["WATCHDOG_USEC"] = str(
+                    int(proc.options.watchdogtimeout * 1000000))
+
+    listeners = ()  # (URL, socket) pairs of the listening sockets
+
+    def openlisteners(self):
+        """Bind the listen addresses of the programs.
+
+        The sockets stay open while subprocesses restart, so that new
+        connections wait in the backlog rather than being refused.  With
+        listen-reuseport, each instance gets TCP sockets of its own, and
+        the kernel spreads connections over them.
+        """
+        self.listeners = []
+        for program in self.programs:
+            options = program.options
+            count = len(options.listen) + options.fdstoremax
+            if options.passfds and options.passfds[0] < 3 + count:
+                self.options.usage(
+                    "pass-fds can't use file descriptors below %d, which"
+                    " are used by listen and fd-store-max" % (3 + count))
+            shared = {}
+            for proc in program.procs:
+                proc.listeners = []
+                for name, url in options.listen:
+                    sock = shared.get(url)
+                    if sock is None or (options.listenreuseport
+                                        and url.startswith("tcp:")):
+                        try:
+                            sock = open_listener(url, options.listenbacklog,
+                                                 options.listenreuseport)
+                        except OSError as err:
+                            self.options.usage("can't listen on %s: %s"
+                                               % (url, err))
+                        self.listeners.append((url, sock))
+                        shared[url] = sock
+                    proc.listeners.append((name, sock))
+
+    def closelisteners(self):
+        for url, sock in self.listeners:
+            if sock.family == socket.AF_UNIX:
+                self.unlink_quietly(sock.getsockname())
+            sock.close()
+
     def unlink_quietly(self, filename):
         try:
             os.unlink(filename)
@@ -332,34 +1040,129 @@ class Daemonizer:
             self.logger.critical(msg)
             sys.exit(1)
 
+    def setinheritance(self):
+        """Make only the descriptors passed to subprocesses inheritable.
+
+        Others, like those zdrun.py itself inherited, are closed on exec.
+        """
+        passfds = set()
+        for program in self.programs:
+            passfds.update(program.options.passfds)
+        for fd in sorted(passfds):
+            try:
+                os.set_inheritable(fd, True)
+            except OSError:
+                self.options.usage("can't pass file descriptor %d: not open"
+                                   % fd)
+        for fd in inheritable_fds():
+            if fd not in passfds:
+                os.set_inheritable(fd, False)
+
+    usepidfd = False  # Watch the subprocess with a pidfd, not SIGCHLD
+
+    def choosechildtracking(self):
+        mode = self.options.childtracking
+        if mode == "sigchld":
+            return False
+        supported = pidfd_supported()
+        if mode == "pidfd" and not supported:
+            self.options.usage("pidfd child tracking is not supported here")
+        return supported
+
     def setsignals(self):
         signal.signal(signal.SIGTERM, self.sigexit)
         signal.signal(signal.SIGHUP, self.sigexit)
         signal.signal(signal.SIGINT, self.sigexit)
-        signal.signal(signal.SIGCHLD, self.sigchild)
+        if not self.usepidfd:
+            signal.signal(signal.SIGCHLD, self.sigchild)
 
     def sigexit(self, sig, frame):
         self.logger.critical("daemon manager killed by %s", signame(sig))
         sys.exit(1)
 
-    waitstatus = None
+    waitstatuses = ()  # (pid, status) pairs of exited subprocesses
+    subreaper = False  # Whether orphaned descendants are reparented to us
+    strays = 0  # How many such descendants were reaped
+    strayexited = False  # Whether SIGCHLD came for such a descendant
 
     def sigchild(self, sig, frame):
+        # SIGCHLDs may be coalesced, so reap all children that exited.
+        while True:
+            try:
+                pid, sts = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            if self.findproc(pid) is not None:
+                self.logger.debug("controlled process %s exited", pid)
+                self.waitstatuses.append((pid, sts))
+            else:
+                self.otherexited(pid, sts)
+
+    def otherexited(self, pid, sts):
+        """Note the exit of a child that isn't a subprocess."""
+        if self.subreaper and not any(
+                proc.testing and proc.options.starttestprogram
+                for proc in self.procs):
+            # No start test is running, so it's an orphaned descendant
+            # of a subprocess.
+            self.strays += 1
+            self.logger.debug("reaped stray process %s: %s",
+                              pid, decode_wait_status(sts)[1])
+            return
+        # this indicates a race between this ``SIGCHLD`` handler
+        # and a ``wait``.
+        # Record in ``child_exits`` to allow the ``wait`` caller
+        # to get the correct exit status
+        self.logger.debug("unknown process %s exited", pid)
+        self.child_exits[pid] = sts
+
+    def becomesubreaper(self):
         try:
-            pid, sts = os.waitpid(-1, os.WNOHANG)
-        except OSError:
+            set_child_subreaper()
+        except (OSError, ValueError) as err:
+            self.logger.error("can't become a child subreaper: %s", err)
             return
-        if pid:
-            if pid == self.proc.pid:
-                self.logger.debug("controlled process %s exited", pid)
-                self.waitstatus = pid, sts
-            else:  # pragma: nocover
-                # this indicates a race between this ``SIGCHLD`` handler
-                # and a ``wait``.
-                # Record in ``child_exits`` to allow the ``wait`` caller
-                # to get the correct exit status
-                self.logger.debug("unknown process %s exited", pid)
-                self.child_exits[pid] = sts
+        self.subreaper = True
+        if self.usepidfd:
+            # Subprocesses are reaped through their pidfds, so SIGCHLD
+            # is only needed for the orphans we adopt.
+            signal.signal(signal.SIGCHLD, self.sigstray)
+
+    def sigstray(self, sig, frame):
+        # The signal pipe wakes up the event loop, which reaps them.
+        self.strayexited = True
+
+    def reapstrays(self):
+        """Reap exited children that aren't subprocesses.
+
+        This is used with pidfds, which mustn't be raced by waitpid(-1).
+        """
+        mypid = os.getpid()
+        try:
+            zombies = [pid for pid, state, ppid, pgrp in proc_stats()
+                       if ppid == mypid and state == "Z"
+                       and self.findproc(pid) is None]
+        except OSError:  # pragma: nocover
+            return
+        for pid in zombies:
+            try:
+                reaped, sts = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:  # pragma: nocover
+                continue
+            if reaped:
+                self.otherexited(pid, sts)
+
+    def straypids(self):
+        """Return the pids of live children that aren't subprocesses."""
+        mypid = os.getpid()
+        try:
+            return sorted(pid for pid, state, ppid, pgrp in proc_stats()
+                          if ppid == mypid and state != "Z"
+                          and self.findproc(pid) is None)
+        except OSError:  # pragma: nocover
+            return []
 
     transcript = None
 
@@ -418,12 +1221,76 @@ class Daemonizer:
         # additionally recommends ignoring SIGHUP and forking again
         # after the setsid() call, for obscure SVR4 reasons.
 
-    should_be_up = True
-    delay = 0  # If nonzero, delay starting or killing until this time
-    killing = 0  # If true, send SIGKILL when delay expires
-    proc = None  # Subprocess instance
+    programs = ()  # Program instances
+    programsbyname = {}  # Program instances by name
+    procs = ()  # Subprocess instances of all programs
+    proc = None  # The first Subprocess instance
+    reactor = None  # Reactor instance
+
+    @property
+    def should_be_up(self):
+        return any(proc.should_be_up for proc in self.procs)
+
+    retiring = ()  # Subprocess copies tracking replaced generations
+
+    def findproc(self, pid):
+        for proc in [*self.procs, *self.retiring]:
+            if proc.pid == pid:
+                return proc
+        return None
+
+    def running(self, *exclude):
+        """Return the running subprocesses, not counting `exclude`."""
+        return [proc for proc in [*self.procs, *self.retiring]
+                if (proc.pid or proc.lingering) and proc not in exclude]
+
+    def replaced(self, proc):
+        """Return the retiring generation that still serves for `proc`.
+
+        That's the one an overlapping restart is replacing, until the new
+        generation is ready.  Return None if there's none.
+        """
+        for old in self.retiring:
+            if old.successor is proc and not old.killing:
+                return old
+        return None
 
     def runforever(self):
+        self.reactor = Reactor()
+        self.waitstatuses = []
+        self.subscribers = []
+        self.waiters = []
+        self.retiring = []
+        self.opensignalpipe()
+        self.reactor.register(self.mastersocket, self.doaccept)
+        if self.notifysocket is not None:
+            self.reactor.register(self.notifysocket, self.donotify)
+        if self.options.daemon:
+            for program in self.programs:
+                if program.name is not None and program.options.transcript:
+                    program.opentranscript(self.reactor)
+        self.logger.info("daemon manager started")
+        while self.should_be_up or self.running():
+            for proc in self.procs:
+                if (proc.should_be_up and not proc.pid and not proc.delay
+                        and not proc.lingering):
+                    pid = self.spawn(proc)
+                    if not pid:
+                        # Can't fork.  Try again later...
+                        self.setdelay(proc, proc.options.backofflimit)
+            # We're listening and have spawned what we could
+            self.options.reportstartup("ready")
+            if self.waitstatuses:
+                self.reportstatus()
+            self.reactor.run_once()
+            if self.waitstatuses:
+                self.reportstatus()
+            self.checkwaiters()
+        self.checkwaiters()
+        self.logger.info("Exiting")
+        sys.exit(0)
+
+    def opensignalpipe(self):
         sig_r, sig_w = os.pipe()
         fcntl.fcntl(
             sig_r, fcntl.F_SETFL, fcntl.fcntl(
@@ -432,181 +1299,690 @@ class Daemonizer:
             sig_w, fcntl.F_SETFL, fcntl.fcntl(
                 sig_w, fcntl.F_GETFL) | os.O_NONBLOCK)
         signal.set_wakeup_fd(sig_w)
-        self.logger.info("daemon manager started")
-        while self.should_be_up or self.proc.pid:
-            if self.should_be_up and not self.proc.pid and not self.delay:
-                pid = self.proc.spawn()
-                if not pid:
-                    # Can't fork.  Try again later...
-                    self.delay = time.time() + self.backofflimit
-            if self.waitstatus:
-                self.reportstatus()
-            r, w, x = [self.mastersocket, sig_r], [], []
-            if self.commandsocket:
-                r.append(self.commandsocket)
-            timeout = self.options.backofflimit
-            if self.delay:
-                timeout = max(0, min(timeout, self.delay - time.time()))
-                if timeout <= 0:
-                    self.delay = 0
-                    if self.killing and self.proc.pid:
-                        self.proc.kill(signal.SIGKILL)
-                        self.delay = time.time() + self.options.backofflimit
+        self.reactor.register(sig_r, lambda: self.dosignals(sig_r))
+
+    def dosignals(self, sig_r):
+        try:
+            os.read(sig_r, 512)  # don't let the buffer fill up
+        except BlockingIOError:  # pragma: nocover
+            pass
+        if self.strayexited:
+            self.strayexited = False
+            self.reapstrays()
+
+    def spawn(self, proc):
+        restart = bool(proc.lasttime)
+        proc.onready = functools.partial(
+            self.reactor.call_soon_threadsafe, self.procready, proc)
+        if proc.cgroup is not None:
             try:
-                r, w, x = select.select(r, w, x, timeout)
+                proc.cgroup.create(proc.cgrouplimits())
             except OSError as err:
-                if err.args[0] != errno.EINTR:
-                    raise
-                r = w = x = []
-            if self.waitstatus:
-                self.reportstatus()
-            if self.commandsocket and self.commandsocket in r:
-                try:
-                    self.dorecv()
-                except OSError as msg:
-                    self.logger.exception(
-                        "socket.error in dorecv(): %s", str(msg)
-                    )
-                    self.commandsocket = None
-            if self.mastersocket in r:
-                try:
-                    self.doaccept()
-                except OSError as msg:
-                    self.logger.exception(
-                        "socket.error in doaccept(): %s", str(msg)
-                    )
-                    self.commandsocket = None
-            if sig_r in r:
-                os.read(sig_r, 1)  # don't let the buffer fill up
-        self.logger.info("Exiting")
-        sys.exit(0)
+                # The subprocess will fail to join it and exit.
+                self.logger.error("can't set up cgroup %s: %s",
+                                  proc.cgroup.path, err)
+        pid = proc.spawn()
+        if pid:
+            proc.restarts += restart
+            proc.generation += 1
+            if self.usepidfd:
+                self.watchchild(proc)
+            self.emit("spawned", proc)
+            proc.statustext = None
+            proc.stopping = False
+            proc.memory = proc.overlimitsince = None
+            self.monitor(proc)
+            if proc.options.notify:
+                # The subprocess is started when it sends READY=1.
+                proc.testing.add(pid)
+            elif proc.options.readyprobe:
+                proc.testing.add(pid)
+                self.startprobe(proc, pid)
+            elif not proc.testing:
+                # Without a start test, the subprocess is started once
+                # it has kept running for a little while.
+                if proc.options.settletime:
+                    proc.settling = self.reactor.call_later(
+                        proc.options.settletime, self.settled, proc)
+                else:
+                    self.ready(proc)
+        return pid
+
+    def monitor(self, proc):
+        """Start the watchdog and memory checks of a running subprocess."""
+        if proc.options.notify and proc.options.watchdogtimeout:
+            self.feedwatchdog(proc)
+        if proc.options.memorylimit:
+            proc.memorycheck = self.reactor.call_later(
+                proc.options.memorycheckinterval, self.checkmemory, proc)
+
+    def unmonitor(self, proc):
+        self.cancelwatchdog(proc)
+        if proc.memorycheck is not None:
+            proc.memorycheck.cancel()
+            proc.memorycheck = None
+
+    def ready(self, proc):
+        """Note that a subprocess is ready; retire the one it replaces."""
+        self.emit("ready", proc)
+        old = self.replaced(proc)
+        if old is not None:
+            self.logger.info(
+                "%s generation %d is serving; stopping generation %d",
+                proc.name or "process", proc.generation, old.generation)
+            self.stopproc(old)
+
+    def settled(self, proc):
+        proc.settling = None
+        self.ready(proc)
+
+    def procready(self, proc, pid):
+        if proc.pid == pid:
+            self.ready(proc)
+
+    def startprobe(self, proc, pid):
+        proc.probe = make_probe(
+            proc.substitute([proc.options.readyprobe])[0], proc.probeaddress,
+            proc.lasttime, self.reactor, proc.options.probetimeout,
+            functools.partial(self.probed, proc, pid))
+
+    def probed(self, proc, pid, ok):
+        proc.probe = None
+        if proc.pid != pid:  # pragma: nocover
+            return
+        if ok:
+            self.logger.debug("ready probe succeeded")
+            proc.testing.discard(pid)
+            self.ready(proc)
+        else:
+            proc.probe = self.reactor.call_later(
+                proc.options.probeinterval, self.startprobe, proc, pid)
+
+    def cancelprobe(self, proc):
+        if proc.probe is not None:
+            proc.probe.cancel()
+            proc.probe = None
+
+    def donotify(self):
+        while True:
+            try:
+                data, ancdata, flags, addr = self.notifysocket.recvmsg(
+                    4096, NOTIFY_ANCILLARY_SIZE, MSG_CMSG_CLOEXEC)
+            except BlockingIOError:
+                return
+            except OSError as err:  # pragma: nocover
+                self.logger.warning("can't read notify socket: %s", err)
+                return
+            fds = notify_fds(ancdata)
+            pid = notify_sender(ancdata)
+            if pid is not None:
+                proc = self.findproc(pid)
+            else:  # pragma: nocover
+                # Without credentials, we can only attribute messages
+                # to a single subprocess.
+                procs = [proc for proc in self.procs
+                         if proc.pid and proc.options.notify]
+                proc = procs[0] if len(procs) == 1 else None
+            if proc is None or not (proc.options.notify
+                                    or proc.options.fdstoremax):
+                self.logger.debug(
+                    "ignoring notification from pid %s: %r", pid, data)
+                for fd in fds:
+                    os.close(fd)
+                continue
+            self.notified(proc, data, fds)
+
+    def notified(self, proc, data, fds=()):
+        """Handle an sd_notify message from a subprocess.
+
+        `fds` are the file descriptors that came with it; they are
+        closed unless they're stored.
+        """
+        store = remove = False
+        fdname = "stored"
+        for line in data.decode("utf-8", "replace").splitlines():
+            key, eq, value = line.partition("=")
+            if key == "FDSTORE" and value == "1":
+                store = True
+            elif key == "FDSTOREREMOVE" and value == "1":
+                remove = True
+            elif key == "FDNAME":
+                fdname = value
+            elif not proc.options.notify:
+                continue
+            elif key == "READY" and value == "1":
+                if proc.pid in proc.testing:
+                    self.logger.debug("%s notified ready",
+                                      proc.name or "process")
+                    proc.testing.discard(proc.pid)
+                    self.ready(proc)
+            elif key == "STATUS":
+                proc.statustext = value
+            elif key == "STOPPING" and value == "1":
+                proc.stopping = True
+                self.cancelwatchdog(proc)
+            elif key == "WATCHDOG" and proc.watchdog is not None:
+                if value == "1":
+                    self.feedwatchdog(proc)
+                elif value == "trigger":
+                    self.watchdogexpired(proc)
+        fds = list(fds)
+        if (store or remove) and not valid_fdname(fdname):
+            self.logger.warning("%s sent bad file descriptor name %r",
+                                proc.name or "process", fdname)
+        elif remove:
+            self.unstorefds(proc, fdname)
+        elif store:
+            self.storefds(proc, fdname, fds)
+            fds = []
+        for fd in fds:
+            os.close(fd)
+
+    def storefds(self, proc, name, fds):
+        """Keep descriptors for later incarnations of a subprocess."""
+        for fd in fds:
+            if len(proc.fdstore) < proc.options.fdstoremax:
+                proc.fdstore.append((name, fd))
+            else:
+                self.logger.warning(
+                    "%s file descriptor store is full; dropping %s",
+                    proc.name or "process", name)
+                os.close(fd)
+        self.logger.debug("%s stored %d file descriptors named %s",
+                          proc.name or "process", len(fds), name)
+
+    def unstorefds(self, proc, name):
+        """Close the stored descriptors named `name`, or all for None."""
+        keep = []
+        for fdname, fd in proc.fdstore:
+            if name is None or fdname == name:
+                os.close(fd)
+            else:
+                keep.append((fdname, fd))
+        proc.fdstore[:] = keep
+
+    def feedwatchdog(self, proc):
+        self.cancelwatchdog(proc)
+        proc.watchdog = self.reactor.call_later(
+            proc.options.watchdogtimeout, self.watchdogexpired, proc)
+
+    def cancelwatchdog(self, proc):
+        if proc.watchdog is not None:
+            proc.watchdog.cancel()
+            proc.watchdog = None
+
+    def watchdogexpired(self, proc):
+        proc.watchdog = None
+        self.logger.warning("%s watchdog timeout; restarting",
+                            proc.name or "process")
+        self.emit("watchdog", proc)
+        if proc.pid and not proc.killing:
+            self.stopproc(proc)
+
+    def checkmemory(self, proc):
+        """Sample the memory use; recycle a subprocess that uses too much.
+
+        A subprocess that has used more than memorylimit bytes for
+        memorygrace seconds is restarted like with the restart command,
+        unless it was restarted for this reason less than
+        memorycooldown seconds ago.
+        """
+        options = proc.options
+        proc.memorycheck = self.reactor.call_later(
+            options.memorycheckinterval, self.checkmemory, proc)
+        if proc.killing:
+            return
+        proc.memory = process_memory(proc.pid, options.memorymetric)
+        now = time.monotonic()
+        if proc.memory is None or proc.memory <= options.memorylimit:
+            proc.overlimitsince = None
+            return
+        if proc.overlimitsince is None:
+            proc.overlimitsince = now
+        if now - proc.overlimitsince < options.memorygrace:
+            return
+        if (proc.recycledat is not None
+                and now - proc.recycledat < options.memorycooldown):
+            return
+        self.logger.warning(
+            "%s uses %d bytes (%s), more than %d for %g seconds; restarting",
+            proc.name or "process", proc.memory, options.memorymetric,
+            options.memorylimit, now - proc.overlimitsince)
+        proc.recycles += 1
+        proc.recycledat = now
+        proc.lastrecycle = (time.time(), proc.memory)
+        self.emit("recycle", proc, memory=proc.memory)
+        self.resetproc(proc, True)
+        self.restartproc(proc)
+
+    def watchchild(self, proc):
+        # A process that already exited stays a zombie until we reap
+        # it, so opening its pidfd can't race with its exit.
+        proc.pidfd = os.pidfd_open(proc.pid)
+        self.reactor.register(proc.pidfd, lambda: self.reapchild(proc))
+
+    def rewatchchild(self, proc):
+        """Reap through `proc` the process it took over from a copy."""
+        if proc.pidfd is not None:
+            self.reactor.modify(proc.pidfd, lambda: self.reapchild(proc),
+                                selectors.EVENT_READ)
+
+    def reapchild(self, proc):
+        pidfd = proc.pidfd
+        info = os.waitid(os.P_PIDFD, pidfd, os.WEXITED | os.WNOHANG)
+        if info is None:  # pragma: nocover
+            return  # Spurious wakeup; the process is still running.
+        self.reactor.unregister(pidfd)
+        os.close(pidfd)
+        proc.pidfd = None
+        self.logger.debug("controlled process %s exited", info.si_pid)
+        self.waitstatuses.append((info.si_pid, waitid_status(info)))
+
+    def setdelay(self, proc, seconds):
+        """Delay starting (or killing, see `killing`) by `seconds`."""
+        self.canceldelay(proc)
+        proc.delay = self.reactor.call_later(
+            seconds, self.delayexpired, proc)
+
+    def canceldelay(self, proc):
+        if proc.delay is not None:
+            proc.delay.cancel()
+            proc.delay = None
+
+    def delayexpired(self, proc):
+        proc.delay = None
+        if proc.circuitopen:
+            self.logger.info("%s restart circuit closed",
+                             proc.name or "process")
+            proc.circuitopen = False
+            self.emit("circuit-closed", proc)
+        if proc.killing and (proc.pid or proc.lingering):
+            self.stopstep(proc, proc.killing)
 
     def reportstatus(self):
-        pid, sts = self.waitstatus
-        self.waitstatus = None
-        es, msg = decode_wait_status(sts)
-        msg = "pid %d: " % pid + msg
-        if pid != self.proc.pid:
-            msg = "unknown(!=%s) " % self.proc.pid + msg
-            self.logger.warning(msg)
-        else:
-            killing = self.killing
-            if killing:
-                self.killing = 0
-                self.delay = 0
+        while self.waitstatuses:
+            pid, sts = self.waitstatuses.pop(0)
+            es, msg = decode_wait_status(sts)
+            msg = "pid %d: " % pid + msg
+            proc = self.findproc(pid)
+            if proc is None:
+                msg = "unknown(!=%s) " % self.proc.pid + msg
+                self.logger.warning(msg)
+                continue
+            proc.lastexit = (time.time(), sts)
+            if proc.settling is not None:
+                proc.settling.cancel()
+                proc.settling = None
+            self.unmonitor(proc)
+            if proc.ownscgroup:
+                self.killleftovers(proc)
+            if proc.options.readyprobe or proc.options.notify:
+                self.cancelprobe(proc)
+                proc.testing.discard(pid)
+            self.emit("exited", proc, pid=pid, **exit_info(sts))
+            proc.setstatus(sts)
+            if proc.options.processgroup and group_alive(pid):
+                self.waitforgroup(proc, pid, es, msg)
             else:
-                self.governor()
-            self.proc.setstatus(sts)
-            if es in self.options.exitcodes and not killing:
+                self.exited(proc, es, msg)
+
+    def exited(self, proc, es, msg):
+        """Decide what to do now that a subprocess is gone."""
+        if proc.successor is not None:
+            self.retired(proc, msg)
+            return
+        killing = proc.killing
+        old = self.replaced(proc)
+        if old is not None and not killing:
+            # The new generation didn't get ready; keep the old one.
+            self.logger.warning("%s; generation %d keeps serving",
+                                msg, old.generation)
+            self.resumeproc(proc, old)
+            return
+        if killing:
+            proc.killing = 0
+            self.canceldelay(proc)
+        else:
+            self.governor(proc)
+        if es in proc.options.exitcodes and not killing:
+            proc.should_be_up = False
+            if not self.should_be_up and not self.running():
                 msg = msg + "; exiting now"
                 self.logger.info(msg)
+                self.checkwaiters()
                 sys.exit(es)
-            self.logger.info(msg)
-
-    backoff = 0
-
-    def governor(self):
+            msg = msg + "; not restarting"
+        self.logger.info(msg)
+        if proc.should_be_up and not killing:
+            self.ratelimit(proc)
+        if not proc.should_be_up:
+            # It was stopped, so it has nothing to resume.
+            self.unstorefds(proc, None)
+
+    def retired(self, old, msg):
+        """Forget a generation replaced by an overlapping restart."""
+        self.retiring.remove(old)
+        old.killing = 0
+        self.canceldelay(old)
+        self.unstorefds(old, None)
+        self.logger.info("%s; generation %d retired", msg, old.generation)
+
+    def waitforgroup(self, proc, pgid, es, msg):
+        """Wait for the rest of an exited subprocess's process group.
+
+        Processes it started may still hold its resources, so it counts
+        as running until they're gone.  If it wasn't being stopped, they
+        are sent the stop signals now; otherwise stopping goes on.
+        """
+        proc.lingering = pgid
+        self.logger.info("%s; waiting for the rest of process group %d",
+                         msg, pgid)
+        if not proc.killing:
+            proc.cleanup = True
+            self.stopproc(proc)
+        proc.groupcheck = self.reactor.call_later(
+            GROUP_POLL_INTERVAL, self.checkgroup, proc, es, msg)
+
+    def checkgroup(self, proc, es, msg):
+        if group_alive(proc.lingering):
+            proc.groupcheck = self.reactor.call_later(
+                GROUP_POLL_INTERVAL, self.checkgroup, proc, es, msg)
+            return
+        self.logger.info("process group %d exited", proc.lingering)
+        proc.groupcheck = None
+        proc.lingering = None
+        if proc.cleanup:
+            # The subprocess wasn't stopped, so it may have to be
+            # restarted like after any exit.
+            proc.cleanup = False
+            proc.killing = 0
+            self.canceldelay(proc)
+        self.exited(proc, es, msg)
+
+    def killleftovers(self, proc):
+        """Kill processes the subprocess started that outlived it."""
+        try:
+            leftovers = proc.cgroup.pids()
+            if leftovers:
+                self.logger.warning(
+                    "killing %d leftover processes in cgroup %s",
+                    len(leftovers), proc.cgroup.path)
+                proc.cgroup.kill()
+        except OSError as err:
+            self.logger.error("can't kill leftover processes in cgroup %s: %s",
+                              proc.cgroup.path, err)
+
+    def governor(self, proc):
         # Back off if respawning too frequently
+        options = proc.options
         now = time.time()
-        if not self.proc.lasttime:
+        if not proc.lasttime:
             pass
-        elif now - self.proc.lasttime < self.options.backofflimit:
+        elif now - proc.lasttime < backoff_setting(options, "reset"):
             # Exited rather quickly; slow down the restarts
-            self.backoff += 1
-            if self.backoff >= self.options.backofflimit:
-                if self.options.forever:
-                    self.backoff = self.options.backofflimit
-                else:
-                    self.logger.critical("restarting too frequently; quit")
+            proc.failures += 1
+            if proc.failures >= options.backofflimit and not options.forever:
+                proc.should_be_up = False
+                if not self.should_be_up and not self.running(proc):
+                    self.logger.critical(
+                        "restarting too frequently; quit")
                     sys.exit(1)
-            self.logger.info("sleep %s to avoid rapid restarts", self.backoff)
-            self.delay = now + self.backoff
+                self.logger.critical(
+                    "%s restarting too frequently; giving up",
+                    proc.name or "process")
+                return
+            proc.backoff = next_backoff(proc.backoff, options)
+            delay = proc.backoff
+            if options.backoffjitter:
+                # Keep processes that failed together from restarting
+                # in lockstep.
+                delay += random.uniform(0, options.backoffjitter)
+            self.logger.info("sleep %g to avoid rapid restarts",
+                             round(delay, 3))
+            self.setdelay(proc, delay)
+            self.emit("backoff", proc, delay=delay)
         else:
             # Reset the backoff timer
-            self.backoff = 0
-            self.delay = 0
+            proc.backoff = 0
+            proc.failures = 0
+            self.canceldelay(proc)
 
-    def doaccept(self):
-        if self.commandsocket:
-            # Give up on previous command socket!
-            self.sendreply("Command superseded by new command")
-            self.commandsocket.close()
-            self.commandsocket = None
-        self.commandsocket, addr = self.mastersocket.accept()
-        try:  # PEP 446, Python >= 3.4
-            self.commandsocket.set_inheritable(True)
-        except AttributeError:
-            pass
-        self.commandbuffer = b""
+    def ratelimit(self, proc):
+        """Count a restart; suspend restarts if there were too many.
 
-    def dorecv(self):
-        data = self.commandsocket.recv(1000)
-        if not data:
-            self.sendreply("Command not terminated by newline")
-            self.commandsocket.close()
-            self.commandsocket = None
-        self.commandbuffer += data
-        if b"\n" in self.commandbuffer:
-            self.docommand()
-            self.commandsocket.close()
-            self.commandsocket = None
-        elif len(self.commandbuffer) > 10000:
-            self.sendreply("Command exceeds 10 KB")
-            self.commandsocket.close()
-            self.commandsocket = None
-
-    def docommand(self):
-        lines = self.commandbuffer.split(b"\n")
-        args = lines[0].split()
-        if not args:
-            self.sendreply("Empty command")
+        More than restartlimit restarts within the last restartwindow
+        seconds open the circuit: the next restart is delayed by
+        circuitopentime seconds.  Restarts long ago don't count, so a
+        process that rarely crashes is never held back.
+        """
+        options = proc.options
+        if not options.restartlimit:
             return
-        command = args[0].decode()
-        methodname = "cmd_" + command
-        method = getattr(self, methodname, None)
-        if method:
-            method([a.decode() for a in args])
+        now = time.monotonic()
+        window = proc.restarttimes
+        window.append(now)
+        while window[0] <= now - options.restartwindow:
+            window.popleft()
+        if len(window) > options.restartlimit:
+            self.logger.warning(
+                "%s restarted %d times in %g seconds; suspending restarts"
+                " for %g seconds", proc.name or "process", len(window) - 1,
+                options.restartwindow, options.circuitopentime)
+            window.clear()
+            proc.circuitopen = True
+            self.setdelay(proc, options.circuitopentime)
+            self.emit("circuit-open", proc, delay=options.circuitopentime)
+
+    def doaccept(self):
+        # Accept every pending client; each gets its own connection.
+        while True:
+            try:
+                sock, addr = self.mastersocket.accept()
+            except BlockingIOError:
+                return
+            except OSError as msg:
+                self.logger.exception(
+                    "socket.error in doaccept(): %s", str(msg))
+                return
+            ControlConnection(sock, self.reactor, self.docommand, self.logger)
+
+    connection = None  # The ControlConnection whose command is running
+
+    def docommand(self, connection, line):
+        self.connection = connection
+        try:
+            args = line.split()
+            if not args:
+                self.sendreply("Empty command")
+                return
+            command = args[0].decode()
+            methodname = "cmd_" + command
+            method = getattr(self, methodname, None)
+            if method:
+                method([a.decode() for a in args])
+            else:
+                self.sendreply(
+                    "Unknown command %r; 'help' for a list" % command)
+        finally:
+            self.connection = None
+
+    def selectprocs(self, *selectors):
+        """Return the subprocesses chosen by selectors.
+
+        A selector is "*" (all subprocesses, also the default), a
+        program name, optionally followed by a colon and a
+        comma-separated list of instance numbers, or just such a list
+        of instance numbers of the program given by the runner
+        section.  If a selector is invalid, send an error reply and
+        return None.
+        """
+        try:
+            return self.chooseprocs(selectors)
+        except ValueError as err:
+            self.sendreply(str(err))
+            return None
+
+    def chooseprocs(self, selectors):
+        """Return the subprocesses chosen by selectors, as selectprocs.
+
+        Raise ValueError for an invalid selector.
+        """
+        if not selectors:
+            selectors = ("*",)
+        procs = []
+        for selector in selectors:
+            if selector == "*":
+                selected = self.procs
+            else:
+                selected = self.selectprogramprocs(selector)
+                if selected is None:
+                    raise ValueError("Bad selector %r" % selector)
+            procs.extend(proc for proc in selected if proc not in procs)
+        return procs
+
+    def selectprogramprocs(self, selector):
+        name, colon, instances = selector.rpartition(":")
+        if not colon:
+            if selector in self.programsbyname:
+                return self.programsbyname[selector].procs
+            name = None
+        program = self.programsbyname.get(name or None)
+        if program is None:
+            return None
+        procs = []
+        for part in instances.split(","):
+            try:
+                instance = int(part)
+                if instance < 0:
+                    raise IndexError(instance)
+                procs.append(program.procs[instance])
+            except (ValueError, IndexError):
+                return None
+        return procs
+
+    def resetproc(self, proc, should_be_up):
+        proc.should_be_up = should_be_up
+        proc.backoff = 0
+        proc.failures = 0
+        self.canceldelay(proc)
+        proc.killing = 0
+        proc.cleanup = False
+        proc.circuitopen = False
+        proc.restarttimes.clear()
+
+    def restartproc(self, proc):
+        """Start restarting a running subprocess; return the signal sent.
+
+        With the overlap restart mode, a subprocess that is ready keeps
+        running while the next generation starts, and is stopped once
+        that is ready; then, None is returned.
+        """
+        if (proc.options.restartmode != "overlap"
+                or procstate(proc) != "running"):
+            return self.stopproc(proc)
+        self.unmonitor(proc)
+        old = proc.retire()
+        self.rewatchchild(old)
+        self.retiring.append(old)
+        self.logger.info(
+            "starting %s generation %d; generation %d serves until it's ready",
+            proc.name or "process", proc.generation + 1, old.generation)
+        if not self.spawn(proc):
+            self.logger.error("can't start %s; generation %d keeps serving",
+                              proc.name or "process", old.generation)
+            self.resumeproc(proc, old)
+        return None
+
+    def resumeproc(self, proc, old):
+        """Let a retiring generation serve again, as if never replaced."""
+        self.retiring.remove(old)
+        proc.resume(old)
+        self.rewatchchild(proc)
+        self.monitor(proc)
+        self.emit("resumed", proc)
+
+    def stopproc(self, proc):
+        """Start stopping a subprocess; return the first signal sent."""
+        return self.stopstep(proc, 0)
+
+    def stopstep(self, proc, step):
+        """Send the signal of a step of stop_steps(); return it.
+
+        The next step is taken when the step's timeout expires.  A last
+        step of SIGKILL is repeated every backofflimit seconds.
+        """
+        steps = stop_steps(proc.options)
+        step = min(step, len(steps) - 1)
+        sig, timeout = steps[step]
+        proc.killing = step + 1
+        name = signame(sig)
+        self.logger.info("sending %s to %s (stop step %d of %d)",
+                         name, proc.name or "process", step + 1, len(steps))
+        proc.kill(sig)
+        if sig == signal.SIGKILL:
+            self.emit("killed", proc, signal=name)
         else:
-            self.sendreply("Unknown command %r; 'help' for a list" % command)
+            self.emit("stopping", proc, signal=name, step=step + 1)
+        if step + 1 < len(steps):
+            if timeout:
+                self.setdelay(proc, timeout)
+        elif sig == signal.SIGKILL:
+            self.setdelay(proc, proc.options.backofflimit)
+        return name
 
     def cmd_start(self, args):
-        self.should_be_up = True
-        self.backoff = 0
-        self.delay = 0
-        self.killing = 0
-        if not self.proc.pid:
-            self.proc.spawn()
+        procs = self.selectprocs(*args[1:])
+        if procs is None:
+            return
+        started = False
+        for proc in procs:
+            self.resetproc(proc, True)
+            if proc.lingering:
+                # Started once the rest of its process group is gone
+                self.stopproc(proc)
+                started = True
+            elif not proc.pid:
+                self.spawn(proc)
+                started = True
+        if started:
             self.sendreply("Application started")
         else:
             self.sendreply("Application already started")
 
     def cmd_stop(self, args):
-        self.should_be_up = False
-        self.backoff = 0
-        self.delay = 0
-        self.killing = 0
-        if self.proc.pid:
-            self.proc.kill(signal.SIGTERM)
-            self.sendreply("Sent SIGTERM")
-            self.killing = 1
-            if self.options.stoptimeut:
-                self.delay = time.time() + self.options.stoptimeut
+        procs = self.selectprocs(*args[1:])
+        if procs is None:
+            return
+        stopping = None
+        for proc in procs:
+            self.resetproc(proc, False)
+            old = self.replaced(proc)
+            if old is not None:
+                sent = self.stopproc(old)
+                stopping = stopping or sent
+            if proc.pid or proc.lingering:
+                sent = self.stopproc(proc)
+                stopping = stopping or sent
+        if stopping:
+            self.sendreply("Sent %s" % stopping)
         else:
             self.sendreply("Application already stopped")
 
     def cmd_restart(self, args):
-        self.should_be_up = True
-        self.backoff = 0
-        self.delay = 0
-        self.killing = 0
-        if self.proc.pid:
-            self.proc.kill(signal.SIGTERM)
-            self.sendreply("Sent SIGTERM; will restart later")
-            self.killing = 1
-            if self.options.stoptimeut:
-                self.delay = time.time() + self.options.stoptimeut
+        procs = self.selectprocs(*args[1:])
+        if procs is None:
+            return
+        stopping = None
+        for proc in procs:
+            self.resetproc(proc, True)
+            if proc.pid or proc.lingering:
+                sent = self.restartproc(proc)
+                stopping = stopping or sent
+            else:
+                self.spawn(proc)
+        if stopping:
+            self.sendreply("Sent %s; will restart later" % stopping)
         else:
-            self.proc.spawn()
             self.sendreply("Application started")
 
     def cmd_kill(self, args):
@@ -618,52 +1994,719 @@ class Daemonizer:
                 return
         else:
             sig = signal.SIGTERM
-        if not self.proc.pid:
+        procs = self.selectprocs(*args[2:])
+        if procs is None:
+            return
+        procs = [proc for proc in procs if proc.pid]
+        if not procs:
             self.sendreply("Application not running")
-        else:
-            msg = self.proc.kill(sig)
+            return
+        for proc in procs:
+            msg = proc.kill(sig)
             if msg:
                 self.sendreply("Kill %d failed: %s" % (sig, msg))
-            else:
-                self.sendreply("Signal %d sent" % sig)
+                return
+        self.sendreply("Signal %d sent" % sig)
 
     def cmd_status(self, args):
-        if not self.proc.pid:
+        if args[1:2] == ["--json"]:
+            self.jsonstatus(args[2:])
+            return
+        procs = self.selectprocs(*args[1:])
+        if procs is None:
+            return
+        proc = procs[0]
+        if not proc.pid:
             status = "stopped"
         else:
             status = "running"
-        self.sendreply("status=%s\n" % status +
-                       "now=%r\n" % time.time() +
-                       "should_be_up=%d\n" % self.should_be_up +
-                       "delay=%r\n" % self.delay +
-                       "backoff=%r\n" % self.backoff +
-                       "lasttime=%r\n" % self.proc.lasttime +
-                       "application=%r\n" % self.proc.pid +
-                       "testing=%d\n" % bool(self.proc.testing) +
-                       "manager=%r\n" % os.getpid() +
-                       "backofflimit=%r\n" % self.options.backofflimit +
-                       "filename=%r\n" % self.proc.filename +
-                       "args=%r\n" % self.proc.args)
+        delay = proc.delay.wallclock() if proc.delay else 0
+        reply = ("status=%s\n" % status +
+                 "now=%r\n" % time.time() +
+                 "should_be_up=%d\n" % any(p.should_be_up for p in procs) +
+                 "delay=%r\n" % delay +
+                 "backoff=%r\n" % proc.backoff +
+                 "lasttime=%r\n" % proc.lasttime +
+                 "application=%r\n" % proc.pid +
+                 "testing=%d\n" % bool(proc.testing) +
+                 "manager=%r\n" % os.getpid() +
+                 "backofflimit=%r\n" % proc.options.backofflimit +
+                 "circuit=%s\n" % ("open" if any(p.circuitopen for p in procs)
+                                   else "closed") +
+                 "filename=%r\n" % proc.filename +
+                 "args=%r\n" % proc.args)
+        if proc.killing:
+            reply += "stop_step=%d\n" % proc.killing
+        if proc.generation:
+            reply += "generation=%d\n" % proc.generation
+        retiring = [old.pid for old in self.retiring if old.successor is proc]
+        if retiring:
+            reply += "retiring=%r\n" % retiring
+        if proc.options.memorylimit:
+            reply += "memory=%r\n" % proc.memory
+            reply += "recycles=%d\n" % proc.recycles
+        if proc.cgroup is not None:
+            reply += "cgroup=%s\n" % proc.cgroup.path
+            for key, value in sorted(proc.cgroup.stats().items()):
+                reply += "%s=%r\n" % (key, value)
+        if self.subreaper:
+            reply += "strays=%d\n" % self.strays
+            reply += "stray_pids=%r\n" % self.straypids()
+        if len(self.procs) > 1:
+            reply += "numprocs=%d\n" % proc.options.numprocs
+            for proc in procs:
+                delay = proc.delay.wallclock() if proc.delay else 0
+                if proc.program.name is not None:
+                    reply += "program=%s " % proc.program.name
+                reply += ("instance=%d status=%s application=%r"
+                          " should_be_up=%d backoff=%r delay=%r"
+                          " lasttime=%r testing=%d\n" % (
+                              proc.instance,
+                              "running" if proc.pid else "stopped",
+                              proc.pid, proc.should_be_up, proc.backoff,
+                              delay, proc.lasttime, bool(proc.testing)))
+        self.sendreply(reply)
+
+    def jsonstatus(self, selectors):
+        """Reply with a JSON document describing the subprocesses.
+
+        The document is a single line, so clients can tell it from
+        other replies by its first character.  Its "version" is
+        incremented when existing fields change meaning; new fields
+        may be added without changing it.
+        """
+        procs = self.selectprocs(*selectors)
+        if procs is None:
+            return
+        self.sendreply(json.dumps({
+            "version": STATUS_VERSION,
+            "manager": os.getpid(),
+            "now": time.time(),
+            "should_be_up": any(proc.should_be_up for proc in procs),
+            "processes": [self.procstatus(proc) for proc in procs],
+            "strays": dict(
+                reaped=self.strays, pids=self.straypids(),
+            ) if self.subreaper else None,
+        }, sort_keys=True))
+
+    def procstatus(self, proc):
+        stopsignal = None
+        if proc.killing:
+            stopsignal = signame(stop_steps(proc.options)[proc.killing - 1][0])
+        lastexit = None
+        if proc.lastexit is not None:
+            when, sts = proc.lastexit
+            lastexit = dict(exit_info(sts), time=when)
+        return {
+            "program": proc.program.name,
+            "instance": proc.instance,
+            "state": procstate(proc),
+            "pid": proc.pid or None,
+            "should_be_up": proc.should_be_up,
+            "testing": bool(proc.testing),
+            "started": proc.lasttime or None,
+            "backoff": proc.backoff,
+            "failures": proc.failures,
+            "stop_step": proc.killing or None,
+            "stop_signal": stopsignal,
+            "lingering_group": proc.lingering,
+            "generation": proc.generation,
+            "retiring": [dict(pid=old.pid or None, generation=old.generation,
+                              state=procstate(old),
+                              stop_step=old.killing or None)
+                         for old in self.retiring if old.successor is proc],
+            "circuit": "open" if proc.circuitopen else "closed",
+            "memory": proc.memory,
+            "recycles": proc.recycles,
+            "last_recycle": None if proc.lastrecycle is None else dict(
+                zip(("time", "memory"), proc.lastrecycle)),
+            "cgroup": None if proc.cgroup is None else dict(
+                proc.cgroup.stats(), path=proc.cgroup.path),
+            "recent_restarts": sum(
+                1 for when in proc.restarttimes
+                if when > time.monotonic() - proc.options.restartwindow),
+            "backofflimit": proc.options.backofflimit,
+            "delay": proc.delay.wallclock() if proc.delay else None,
+            "restarts": proc.restarts,
+            "last_exit": lastexit,
+            "status_text": proc.statustext,
+            "listen": [dict(name=name, address=socket_url(sock))
+                       for name, sock in proc.listeners],
+            "fd_store": [name for name, fd in proc.fdstore],
+            "filename": proc.filename,
+            "args": proc.args,
+        }
+
+    def cmd_subscribe(self, args):
+        """Keep the connection open and stream events as JSON lines."""
+        procs = self.selectprocs(*args[1:])
+        if procs is None:
+            return
+        self.connection.hold()
+        self.subscribers.append((self.connection, procs))
+        self.sendreply(json.dumps({
+            "event": "subscribed",
+            "version": STATUS_VERSION,
+            "time": time.time(),
+        }, sort_keys=True))
+
+    subscribers = ()  # (ControlConnection, procs) pairs of subscribe commands
+
+    def emit(self, event, proc, **fields):
+        """Send an event about a subprocess to its subscribers."""
+        if not self.subscribers:
+            return
+        fields.update(event=event, time=time.time(),
+                      program=proc.program.name, instance=proc.instance)
+        fields.setdefault("pid", proc.pid or None)
+        fields.setdefault("generation", proc.generation)
+        line = (json.dumps(fields, sort_keys=True) + "\n").encode()
+        for connection, procs in self.subscribers:
+            if proc in procs or proc.successor in procs:
+                connection.send(line)
+        self.subscribers = [(connection, procs)
+                            for connection, procs in self.subscribers
+                            if not connection.closed]
+
+    def cmd_wait(self, args):
+        """Reply once the selected subprocesses reach a state.
+
+        The arguments are a state, "running" or "stopped", an optional
+        timeout in seconds, where "-" means no timeout, and selectors.
+        """
+        state = args[1] if args[1:] else None
+        if state not in ("running", "stopped"):
+            self.sendreply("Bad state %r; use running or stopped" % state)
+            return
+        timeout = None
+        if args[2:] and args[2] != "-":
+            try:
+                timeout = float(args[2])
+            except ValueError:
+                self.sendreply("Bad timeout %r" % args[2])
+                return
+        procs = self.selectprocs(*args[3:])
+        if procs is None:
+            return
+        reply = self.waitreply(state, procs)
+        if reply is not None:
+            self.sendreply(reply)
+            return
+        self.connection.hold()
+        waiter = [self.connection, state, procs, None]
+        if timeout is not None:
+            waiter[3] = self.reactor.call_later(
+                timeout, self.waitexpired, waiter)
+        self.waiters.append(waiter)
+
+    waiters = ()  # [ControlConnection, state, procs, Timer] of wait commands
+
+    def waitreply(self, state, procs):
+        """Return the reply to a wait command, or None to keep waiting."""
+        if state == "stopped":
+            procs = procs + [old for old in self.retiring
+                             if old.successor in procs]
+            if not any(proc.pid or proc.lingering for proc in procs):
+                return "stopped"
+        elif all(procstate(proc) == "running" for proc in procs):
+            return "running"
+        elif not all(proc.should_be_up for proc in procs):
+            return "Application stopped"
+        return None
+
+    def checkwaiters(self):
+        if not self.waiters:
+            return
+        waiters = []
+        for waiter in self.waiters:
+            connection, state, procs, timer = waiter
+            reply = None if connection.closed else self.waitreply(state, procs)
+            if reply is None and not connection.closed:
+                waiters.append(waiter)
+                continue
+            if timer is not None:
+                timer.cancel()
+            if reply is not None:
+                connection.send(reply.encode() + b"\n")
+                connection.finish()
+        self.waiters = waiters
+
+    def waitexpired(self, waiter):
+        self.waiters.remove(waiter)
+        connection, state, procs, timer = waiter
+        connection.send(b"Timed out waiting for %s\n" % state.encode())
+        connection.finish()
 
     def cmd_reopen_transcript(self, args):
         reopenFiles()
         if self.transcript is not None:
             self.transcript.reopen()
+        for program in self.programs:
+            if program.transcript is not None:
+                program.transcript.reopen()
 
     def sendreply(self, msg):
+        if not msg.endswith("\n"):
+            msg = msg + "\n"
+        if self.connection is not None:
+            self.connection.send(msg.encode())
+
+
+class ControlConnection:
+
+    """A client connection to the control socket.
+
+    The client sends one command line and gets a reply, after which the
+    connection is closed.  Reads and writes never block; the reactor
+    calls `ready` when they can make progress, so a slow client can't
+    hold up the daemon manager or other clients.  A client that doesn't
+    send its command and read the reply within `timeout` seconds is
+    disconnected.
+
+    A command can `hold` the connection to keep sending to the client
+    after the command returns; it calls `finish` when it's done.
+    """
+
+    timeout = 30  # Seconds a client may take
+    maxcommand = 10000  # Maximum length of a command line in bytes
+    maxoutput = 1 << 20  # Maximum bytes of output the client may lag behind
+
+    def __init__(self, sock, reactor, oncommand, logger):
+        self.sock = sock
+        self.reactor = reactor
+        self.oncommand = oncommand
+        self.logger = logger
+        self.inbuffer = b""
+        self.outbuffer = b""
+        self.reading = True  # Waiting for the command or end of input
+        self.held = False  # The command isn't done sending
+        self.done = False  # No more output will be added
+        sock.setblocking(False)
+        self.events = selectors.EVENT_READ
+        reactor.register(sock, self.ready, self.events)
+        self.timer = reactor.call_later(self.timeout, self.expired)
+
+    @property
+    def closed(self):
+        return self.sock is None
+
+    def watch(self):
+        """Tell the reactor what we're waiting for."""
+        if self.closed:
+            return
+        events = 0
+        if self.reading:
+            events |= selectors.EVENT_READ
+        if self.outbuffer:
+            events |= selectors.EVENT_WRITE
+        if events == self.events:
+            return
+        if not events:
+            self.reactor.unregister(self.sock)
+        elif not self.events:
+            self.reactor.register(self.sock, self.ready, events)
+        else:
+            self.reactor.modify(self.sock, self.ready, events)
+        self.events = events
+
+    def ready(self):
+        if self.outbuffer:
+            self.flush()
+        if self.reading and not self.closed:
+            self.read()
+        self.watch()
+
+    def read(self):
         try:
-            if not msg.endswith("\n"):
-                msg = msg + "\n"
-            msg = msg.encode()
-            if hasattr(self.commandsocket, "sendall"):
-                self.commandsocket.sendall(msg)
-            else:  # pragma: nocover
-                # This is quadratic, but msg is rarely more than 100 bytes :-)
-                while msg:
-                    sent = self.commandsocket.send(msg)
-                    msg = msg[sent:]
+            data = self.sock.recv(1000)
+        except BlockingIOError:
+            return
+        except OSError as msg:
+            self.logger.warning("Error receiving command: %s", str(msg))
+            self.close()
+            return
+        if self.held:
+            # Input after the command is ignored; the client may
+            # still read from its end after closing its writing end.
+            self.reading = bool(data)
+            return
+        if not data:
+            self.reading = False
+            self.send(b"Command not terminated by newline\n")
+            self.finish()
+            return
+        self.inbuffer += data
+        if b"\n" in self.inbuffer:
+            line = self.inbuffer.split(b"\n", 1)[0]
+            self.inbuffer = b""
+            self.reading = False
+            self.oncommand(self, line)
+            if not self.held:
+                self.finish()
+        elif len(self.inbuffer) > self.maxcommand:
+            self.reading = False
+            self.send(b"Command exceeds 10 KB\n")
+            self.finish()
+
+    def send(self, data):
+        if self.closed or self.done:
+            return
+        self.outbuffer += data
+        if len(self.outbuffer) > self.maxoutput:
+            self.logger.warning("Closing control connection that doesn't"
+                                " read its output")
+            self.close()
+            return
+        self.flush()
+        self.watch()
+
+    def flush(self):
+        try:
+            while self.outbuffer:
+                sent = self.sock.send(self.outbuffer)
+                self.outbuffer = self.outbuffer[sent:]
+        except BlockingIOError:
+            return  # Wait until the client reads some of its output.
         except OSError as msg:
             self.logger.warning("Error sending reply: %s", str(msg))
+            self.close()
+            return
+        if self.done:
+            self.close()
+
+    def hold(self):
+        """Keep the connection open after the command returns.
+
+        The timeout no longer applies.
+        """
+        self.held = True
+        self.reading = True
+        self.timer.cancel()
+
+    def finish(self):
+        """Close the connection once the reply has been sent."""
+        if self.closed:
+            return
+        self.done = True
+        self.reading = False
+        if self.outbuffer:
+            self.watch()
+        else:
+            self.close()
+
+    def expired(self):
+        self.logger.warning("Closing control connection after %s seconds",
+                            self.timeout)
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.timer.cancel()
+        self.reactor.unregister(self.sock)
+        self.sock.close()
+        self.sock = None
+
+
+class CGroup:
+
+    """A cgroup v2 directory that a subprocess runs in.
+
+    Files are only written if they exist, as in the cgroup file system,
+    where a missing file means that a controller isn't enabled.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self, name):
+        with open(os.path.join(self.path, name)) as f:
+            return f.read()
+
+    def write(self, name, value):
+        fd = os.open(os.path.join(self.path, name), os.O_WRONLY | os.O_TRUNC)
+        try:
+            os.write(fd, str(value).encode())
+        finally:
+            os.close(fd)
+
+    def create(self, limits):
+        """Create the cgroup, unless it exists, and set its limits.
+
+        `limits` is a list of (interface file, value) pairs.  When the
+        cgroup is created, the controllers the limits need are enabled
+        in its parent first.
+        """
+        if not os.path.isdir(self.path):
+            controllers = sorted({name.split(".")[0] for name, v in limits})
+            if controllers:
+                parent = CGroup(os.path.dirname(self.path))
+                try:
+                    parent.write("cgroup.subtree_control", " ".join(
+                        "+" + controller for controller in controllers))
+                except OSError:
+                    pass  # Already enabled, or not ours to enable
+            os.makedirs(self.path)
+        for name, value in limits:
+            self.write(name, value)
+
+    def join(self, pid):
+        """Move a process into the cgroup."""
+        self.write("cgroup.procs", pid)
+
+    def pids(self):
+        return [int(pid) for pid in self.read("cgroup.procs").split()]
+
+    def kill(self):
+        """Kill all processes in the cgroup with SIGKILL."""
+        try:
+            self.write("cgroup.kill", 1)
+        except FileNotFoundError:
+            # Linux before 5.14; processes forking meanwhile may escape.
+            for pid in self.pids():
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def stats(self):
+        """Return the resource usage of the processes in the cgroup.
+
+        Figures the kernel doesn't provide are None.
+        """
+        stats = dict.fromkeys(("memory_current", "cpu_usage_usec",
+                               "cpu_user_usec", "cpu_system_usec",
+                               "io_rbytes", "io_wbytes"))
+        try:
+            stats["memory_current"] = int(self.read("memory.current"))
+        except (OSError, ValueError):
+            pass
+        try:
+            for line in self.read("cpu.stat").splitlines():
+                key, value = line.split()
+                if "cpu_" + key in stats:
+                    stats["cpu_" + key] = int(value)
+        except (OSError, ValueError):
+            pass
+        try:
+            io = self.read("io.stat")
+        except OSError:
+            pass
+        else:
+            # One line per device, like "8:0 rbytes=1 wbytes=2 ..."
+            stats["io_rbytes"] = stats["io_wbytes"] = 0
+            for line in io.splitlines():
+                for field in line.split()[1:]:
+                    key, eq, value = field.partition("=")
+                    if key in ("rbytes", "wbytes"):
+                        stats["io_" + key] += int(value)
+        return stats
+
+
+class Probe:
+
+    """Check once, without blocking, whether a subprocess is ready.
+
+    `callback` is called with True or False from the reactor, unless
+    the probe is cancelled first.  A probe that takes longer than
+    `timeout` seconds fails.
+    """
+
+    def __init__(self, reactor, timeout, callback):
+        self.reactor = reactor
+        self.callback = callback
+        self.timer = reactor.call_later(timeout, self.done, False)
+
+    def done(self, ok):
+        callback = self.callback
+        self.cancel()
+        if callback is not None:
+            callback(ok)
+
+    def cancel(self):
+        self.callback = None
+        self.timer.cancel()
+        self.close()
+
+    def close(self):
+        pass
+
+
+class FileProbe(Probe):
+
+    """Ready when a file was modified after the subprocess started."""
+
+    def __init__(self, reactor, timeout, callback, path, since):
+        Probe.__init__(self, reactor, timeout, callback)
+        try:
+            # File system timestamps come from a coarse clock that can
+            # lag the one `since` was read from by a clock tick.
+            ok = os.stat(path).st_mtime >= since - 0.05
+        except OSError:
+            ok = False
+        reactor.call_later(0, self.done, ok)
+
+
+class ConnectProbe(Probe):
+
+    """Ready when a stream socket connection is accepted.
+
+    `family` and `address` are as returned by `probe_address`.  An
+    address that can't be connected to makes the attempt fail.
+    """
+
+    sock = None
+
+    def __init__(self, reactor, timeout, callback, family, address):
+        Probe.__init__(self, reactor, timeout, callback)
+        try:
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
+            self.sock.setblocking(False)
+            err = self.sock.connect_ex(address)
+        except OSError:
+            reactor.call_later(0, self.done, False)
+            return
+        if err in (errno.EINPROGRESS, errno.EAGAIN):
+            reactor.register(self.sock, self.connected, selectors.EVENT_WRITE)
+        else:
+            reactor.call_later(0, self.checkconnected, err)
+
+    def connected(self):
+        self.reactor.unregister(self.sock)
+        self.checkconnected(
+            self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR))
+
+    def checkconnected(self, err):
+        if self.callback is None:  # pragma: nocover
+            return
+        if err:
+            self.done(False)
+        else:
+            self.ready()
+
+    def ready(self):
+        """The connection was accepted."""
+        self.done(True)
+
+    def close(self):
+        if self.sock is not None:
+            self.reactor.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
+
+
+class HTTPProbe(ConnectProbe):
+
+    """Ready when a GET request gets a 2xx response."""
+
+    def __init__(self, reactor, timeout, callback, family, address,
+                 host, port, path):
+        hostport = "[%s]" % host if ":" in host else host
+        if port != 80:
+            hostport += ":%d" % port
+        self.request = ("GET %s HTTP/1.0\r\nHost: %s\r\n"
+                        "Connection: close\r\n\r\n" % (path, hostport)
+                        ).encode()
+        self.response = b""
+        ConnectProbe.__init__(self, reactor, timeout, callback,
+                              family, address)
+
+    def ready(self):
+        try:
+            # A small request fits in an empty socket buffer.
+            self.sock.send(self.request)
+        except OSError:
+            self.done(False)
+            return
+        self.reactor.register(self.sock, self.readable)
+
+    def readable(self):
+        try:
+            data = self.sock.recv(1000)
+        except BlockingIOError:  # pragma: nocover
+            return
+        except OSError:
+            data = b""
+        self.response += data
+        if b"\r\n" in self.response or not data:
+            status = self.response.split(b"\r\n", 1)[0].split()
+            self.done(len(status) > 1 and status[1].startswith(b"2"))
+
+
+def probe_address(url):
+    """Return the (family, address) a ready-probe URL connects to.
+
+    Host names are resolved to their first address, of whatever family
+    it has; OSError is raised if that fails.  File probes have no
+    address; None is returned for them.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == "file":
+        return None
+    if parts.scheme == "unix":
+        return socket.AF_UNIX, parts.path
+    family, type, proto, name, address = socket.getaddrinfo(
+        parts.hostname, parts.port or 80, type=socket.SOCK_STREAM)[0]
+    return family, address
+
+
+def make_probe(url, address, since, reactor, timeout, callback):
+    """Start checking a ready-probe URL.
+
+    See `zdaemon.zdoptions.probe_url` for the supported URLs.  `address`
+    is what `probe_address` returns for the URL, and `since` is the time
+    the subprocess started, for file probes.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == "file":
+        return FileProbe(reactor, timeout, callback, parts.path, since)
+    if parts.scheme == "http":
+        return HTTPProbe(reactor, timeout, callback, *address,
+                         parts.hostname, parts.port or 80, parts.path or "/")
+    return ConnectProbe(reactor, timeout, callback, *address)
+
+
+def open_listener(url, backlog, reuseport=False):
+    """Return a socket listening on a listen address.
+
+    See `zdaemon.zdoptions.listen_addresses` for the supported URLs.
+    A stale Unix socket left behind by an earlier run is replaced.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == "unix":
+        family, address = socket.AF_UNIX, parts.path
+        try:
+            if S_ISSOCK(os.stat(address).st_mode):
+                os.unlink(address)
+        except OSError:
+            pass
+    else:
+        family, type, proto, name, address = socket.getaddrinfo(
+            parts.hostname or None, parts.port, type=socket.SOCK_STREAM,
+            flags=socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if family != socket.AF_UNIX:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuseport:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+        sock.listen(backlog)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def socket_url(sock):
+    """Return the address a socket is bound to as a tcp or unix URL."""
+    address = sock.getsockname()
+    if sock.family == socket.AF_UNIX:
+        return "unix://" + address
+    host = address[0]
+    if sock.family == socket.AF_INET6:
+        host = "[%s]" % host
+    return "tcp://%s:%d" % (host, address[1])
 
 
 class Transcript:
@@ -706,8 +2749,259 @@ class Transcript:
             self.write = self.file.write
 
 
+class ProgramTranscript:
+
+    """Copy the output of a program's subprocesses to a file.
+
+    Unlike `Transcript`, this doesn't need a thread; the reactor calls
+    `copy` when there's output to copy.
+    """
+
+    def __init__(self, filename, reactor):
+        self.read_from, self.write_to = os.pipe()
+        self.filename = filename
+        self.file = open(filename, 'ab', 0)
+        reactor.register(self.read_from, self.copy)
+
+    def copy(self):
+        self.file.write(os.read(self.read_from, 8192))
+
+    def reopen(self):
+        new_file = open(self.filename, 'ab', 0)
+        self.file.close()
+        self.file = new_file
+
+
+# ioprio_set system call numbers by machine (Linux only)
+IOPRIO_SET = {
+    "x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "riscv64": 30,
+    "armv7l": 314, "ppc64le": 273, "ppc64": 273, "s390x": 282,
+}
+
+
+def ioprio_set(ioclass, level):
+    """Set the I/O scheduling class and level of the current process.
+
+    The standard library doesn't wrap this system call.
+    """
+    import ctypes  # only needed here, in the child, so import it lazily
+    number = IOPRIO_SET.get(os.uname().machine)
+    if number is None or not sys.platform.startswith("linux"):
+        raise ValueError("ionice isn't supported here")
+    libc = ctypes.CDLL(None, use_errno=True)
+    ioprio = IONICE_CLASSES[ioclass] << 13 | level
+    # IOPRIO_WHO_PROCESS, and 0 for the current process
+    if libc.syscall(number, 1, 0, ioprio) < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "ioprio_set: " + os.strerror(err))
+
+
+PR_SET_CHILD_SUBREAPER = 36  # From <linux/prctl.h>
+
+
+def set_child_subreaper():
+    """Have orphaned descendants reparented to us rather than to init.
+
+    This needs Linux 3.4 or later.
+    """
+    if not sys.platform.startswith("linux"):
+        raise ValueError("child subreapers aren't supported here")
+    import ctypes  # only needed here, so import it lazily
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "prctl: " + os.strerror(err))
+
+
+def stop_steps(options):
+    """Return the (signal, timeout) steps for stopping a subprocess.
+
+    Without stop-signals, the subprocess gets SIGTERM, and SIGKILL
+    after stop-timeout seconds, if that's set.  Steps of stop-signals
+    without a timeout wait stop-timeout seconds.
+    """
+    timeout = options.stoptimeut
+    if not options.stopsignals:
+        if not timeout:
+            return [(signal.SIGTERM, None)]
+        return [(signal.SIGTERM, timeout), (signal.SIGKILL, None)]
+    return [(sig, timeout if step_timeout is None else step_timeout)
+            for sig, step_timeout in options.stopsignals]
+
+
+try:
+    MAXFD = os.sysconf("SC_OPEN_MAX")
+except (AttributeError, ValueError):  # pragma: nocover
+    MAXFD = 256
+
+
+def inheritable_fds():
+    """Return the open file descriptors above 2 that exec would keep."""
+    try:
+        fds = [int(name) for name in os.listdir("/proc/self/fd")]
+    except OSError:  # pragma: nocover
+        fds = range(3, MAXFD)
+    inheritable = []
+    for fd in fds:
+        if fd > 2:
+            try:
+                if os.get_inheritable(fd):
+                    inheritable.append(fd)
+            except OSError:
+                pass  # Not open, like the one used for listing
+    return inheritable
+
+
+GROUP_POLL_INTERVAL = 0.1  # Seconds between checks for a group's members
+
+
+def group_alive(pgid):
+    """Return whether the process group `pgid` has live members.
+
+    Zombies don't count, or an init that doesn't reap orphans would keep
+    the group alive forever.  They are only told apart where there's a
+    /proc file system.
+    """
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:
+        return any(pgrp == pgid and state != "Z"
+                   for pid, state, ppid, pgrp in proc_stats())
+    except OSError:
+        return True
+
+
+def proc_stats():
+    """Return (pid, state, ppid, pgrp) tuples for all processes.
+
+    This reads /proc, so it's Linux only; OSError is raised elsewhere.
+    """
+    stats = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name) as f:
+                stat = f.read()
+        except OSError:
+            continue  # It exited meanwhile
+        # The command name before the state may contain anything.
+        state, ppid, pgrp = stat[stat.rindex(")") + 2:].split()[:3]
+        stats.append((int(name), state, int(ppid), int(pgrp)))
+    return stats
+
+
+def process_memory(pid, metric="rss"):
+    """Return the memory use of a process in bytes, or None if unknown.
+
+    The metric is "rss", the resident set size, or "pss", the
+    proportional set size, which divides shared pages among the
+    processes sharing them (Linux only).
+    """
+    if metric == "pss":
+        filename, field = "/proc/%d/smaps_rollup" % pid, "Pss:"
+    else:
+        filename, field = "/proc/%d/status" % pid, "VmRSS:"
+    try:
+        with open(filename) as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024  # in kB
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def backoff_setting(options, name):
+    """Return backoff-max or backoff-reset; both default to backoff-limit."""
+    value = getattr(options, "backoff" + name)
+    return options.backofflimit if value is None else value
+
+
+def next_backoff(backoff, options):
+    """Return the restart delay following `backoff` (0 for the first).
+
+    The delay starts at backoff-initial and then grows by multiplying
+    it with backoff-multiplier, or, if that isn't set, by adding
+    backoff-initial, up to backoff-max.
+    """
+    if not backoff:
+        backoff = options.backoffinitial
+    elif options.backoffmultiplier is None:
+        backoff += options.backoffinitial
+    else:
+        backoff *= options.backoffmultiplier
+    return min(backoff, backoff_setting(options, "max"))
+
+
+CREDENTIALS = struct.Struct("3i")  # struct ucred: pid, uid, gid
+
+
+# Room for the sender's credentials and as many descriptors as the
+# kernel sends with one message (SCM_MAX_FD)
+NOTIFY_ANCILLARY_SIZE = (socket.CMSG_SPACE(CREDENTIALS.size)
+                         + socket.CMSG_SPACE(253 * array.array("i").itemsize))
+MSG_CMSG_CLOEXEC = getattr(socket, "MSG_CMSG_CLOEXEC", 0)
+
+
+def notify_fds(ancdata):
+    """Return the file descriptors passed with a message."""
+    fds = array.array("i")
+    for level, type, data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    return list(fds)
+
+
+def valid_fdname(name):
+    """Return whether `name` can be passed on in LISTEN_FDNAMES."""
+    return (0 < len(name) <= 255 and name.isprintable()
+            and ":" not in name and " " not in name)
+
+
+def notify_sender(ancdata):
+    """Return the sender pid from the ancillary data of a message.
+
+    Return None if the message carries no credentials.
+    """
+    for level, type, data in ancdata:
+        if (level == socket.SOL_SOCKET
+                and type == getattr(socket, "SCM_CREDENTIALS", None)):
+            return CREDENTIALS.unpack(data[:CREDENTIALS.size])[0]
+    return None
+
+
+def procstate(proc):
+    """Return the state of a Subprocess as reported by status --json."""
+    if proc.pid:
+        if proc.killing or proc.stopping:
+            return "stopping"
+        if proc.testing or proc.settling:
+            return "starting"
+        return "running"
+    if proc.lingering:
+        return "stopping"
+    if proc.should_be_up:
+        return "backoff" if proc.delay else "starting"
+    return "stopped"
+
+
 # Helpers for dealing with signals and exit status
 
+def exit_info(sts):
+    """Describe a wait status for JSON documents and events."""
+    es, msg = decode_wait_status(sts)
+    return {
+        "exitstatus": es if os.WIFEXITED(sts) else None,
+        "signal": signame(os.WTERMSIG(sts)) if os.WIFSIGNALED(sts) else None,
+        "message": msg,
+    }
+
+
 def decode_wait_status(sts):
     """Decode the status returned by wait() or waitpid().
 
@@ -735,6 +3029,40 @@ def decode_wait_status(sts):
         return -1, msg
 
 
+def waitid_status(info):
+    """Convert the result of os.waitid() to a waitpid()-style status."""
+    if info.si_code == os.CLD_EXITED:
+        return (info.si_status & 0xff) << 8
+    sts = info.si_status & 0x7f
+    if info.si_code == os.CLD_DUMPED:
+        sts |= 0x80
+    return sts
+
+
+def pidfd_supported():
+    """Return whether children can be watched and reaped using pidfds.
+
+    This needs os.pidfd_open() (Linux 5.3) and waitid(P_PIDFD) (Linux
+    5.4).  The latter is probed by waiting for ourselves, which fails
+    with ECHILD if P_PIDFD is understood and EINVAL otherwise.
+    """
+    if not hasattr(os, "pidfd_open") or not hasattr(os, "P_PIDFD"):
+        return False
+    try:
+        pidfd = os.pidfd_open(os.getpid())
+    except OSError:
+        return False
+    try:
+        os.waitid(os.P_PIDFD, pidfd, os.WEXITED | os.WNOHANG)
+    except ChildProcessError:
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(pidfd)
+    return True  # pragma: nocover
+
+
 _signames = None
 
 